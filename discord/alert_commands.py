@@ -0,0 +1,78 @@
+from discord.ext import commands
+import discord
+import alerts
+import coin_data
+
+class Alerts(object):
+  """Commands for getting PMed when a coin's price moves."""
+
+  def __init__(self, bot):
+    self.bot = bot
+
+  async def Deliver(self, user_id, text):
+    """Send an alert notification; passed to alerts.DeliverForever."""
+    user = discord.utils.get(self.bot.get_all_members(), id=user_id)
+    if user is None:
+      user = await self.bot.get_user_info(user_id)
+    await self.bot.send_message(user, text)
+
+  @commands.command(pass_context=True)
+  async def alert(self, ctx, symbol : str, *condition : str):
+    """PM you once when a coin crosses a price, or moves by a percentage.
+
+    example: !alert BTC above 20000
+    example: !alert ETH below 500
+    example: !alert XRB 10%
+    """
+    user = ctx.message.author
+    symbol = symbol.upper()
+    history = coin_data.GetHistory(symbol)
+    price = history.GetValue()
+    # GetValue is 0.0 for symbols with no data, which no alert makes sense for.
+    if not history.Exists() or price <= 0:
+      await self.bot.say('Unknown symbol %s.' % symbol)
+      return
+    try:
+      if len(condition) == 1 and condition[0].endswith('%'):
+        percent = abs(float(condition[0][:-1]))
+        alert = alerts.Create(user.id, symbol, above=price*(1 + percent/100),
+                              below=price*(1 - percent/100), percent=percent,
+                              base=price)
+      elif len(condition) == 2 and condition[0] in ('above', 'below'):
+        level = float(condition[1])
+        if (condition[0] == 'above') == (price >= level):
+          await self.bot.say('%s is already %s $%g (at $%s).' % (
+              symbol, condition[0], level, price))
+          return
+        alert = alerts.Create(user.id, symbol, **{condition[0]: level})
+      else:
+        raise ValueError()
+    except ValueError:
+      await self.bot.say('Format has to be "!alert SYMBOL above|below PRICE" '
+                         'or "!alert SYMBOL PERCENT%".')
+      return
+    except alerts.AlertLimitReached:
+      await self.bot.say('You already have %s alerts, remove some with '
+                         '!unalert.' % alerts.MAX_ALERTS_PER_USER)
+      return
+    await self.bot.say('Alert %s: I\'ll PM %s when %s.' % (
+        alert.id, user, alert.Describe()))
+
+  @commands.command(name='alerts', pass_context=True)
+  async def list_alerts(self, ctx):
+    """List your alerts."""
+    user = ctx.message.author
+    user_alerts = alerts.GetAlerts(user.id)
+    if not user_alerts:
+      await self.bot.say('%s has no alerts.' % user)
+      return
+    await self.bot.say('```%s\'s alerts:\n%s```' % (user, '\n'.join(
+        '%s: %s' % (alert.id, alert.Describe()) for alert in user_alerts)))
+
+  @commands.command(pass_context=True)
+  async def unalert(self, ctx, alert_id : int):
+    """Remove one of your alerts, by the number !alerts lists it under."""
+    if alerts.Delete(ctx.message.author.id, alert_id):
+      await self.bot.say('Removed alert %s.' % alert_id)
+    else:
+      await self.bot.say('You have no alert %s.' % alert_id)
@@ -0,0 +1,187 @@
+"""Price alerts, checked against every tick the bot follows.
+
+Users register a price level to watch for (above or below), or a percent
+move from the current price, which becomes one level on each side. Alerts
+are stored in the alerts table and, in memory, in per-symbol sorted lists of
+levels: a tick only looks at the prefix (or suffix) of levels that the new
+price crossed, so its cost is proportional to the alerts that fire rather
+than to the number registered. Alerts fire once and are then deleted.
+
+Notifications go through a bounded queue that is drained at a fixed rate,
+one message per user per tick, so a market-wide crash can't flood discord.
+
+Example usage:
+  alerts.Load()
+  coin_data.AddTickListener(alerts.OnTick)
+  bot.loop.create_task(alerts.DeliverForever(SendToUser))
+"""
+from sortedcontainers import SortedList
+import asyncio
+import collections
+import traceback
+import metrics
+import sql
+
+# The most alerts a user can have waiting at once.
+MAX_ALERTS_PER_USER = 20
+# Notifications waiting beyond this many are dropped.
+MAX_PENDING_NOTIFICATIONS = 1000
+# How many notifications are sent per second at most.
+NOTIFICATIONS_PER_SECOND = 1.0
+
+_alerts = {}
+# Symbol -> SortedList of (price, alert id), for each direction.
+_above = collections.defaultdict(SortedList)
+_below = collections.defaultdict(SortedList)
+_notifications = None
+
+
+class AlertLimitReached(Exception):
+  """The user already has MAX_ALERTS_PER_USER alerts."""
+
+
+class Alert(object):
+
+  def __init__(self, alert_id, user_id, symbol, above=None, below=None,
+               percent=None, base=None):
+    self.id = alert_id
+    self.user_id = user_id
+    self.symbol = symbol
+    self.above = above
+    self.below = below
+    self.percent = percent
+    self.base = base
+
+  def Describe(self):
+    if self.percent is not None:
+      return '%s moves %g%% from $%s (below $%.6g or above $%.6g)' % (
+          self.symbol, self.percent, self.base, self.below, self.above)
+    if self.above is not None:
+      return '%s goes above $%g' % (self.symbol, self.above)
+    return '%s goes below $%g' % (self.symbol, self.below)
+
+
+def Load():
+  """Read every alert from the database into the in-memory index."""
+  _alerts.clear()
+  _above.clear()
+  _below.clear()
+  with sql.GetCursor(streaming=True) as cursor:
+    cursor.execute('SELECT id, user_id, symbol, above, below, percent, base '
+                   'FROM alerts')
+    for row in sql.IterRows(cursor):
+      _Index(Alert(*row))
+
+
+def _Index(alert):
+  _alerts[alert.id] = alert
+  if alert.above is not None:
+    _above[alert.symbol].add((alert.above, alert.id))
+  if alert.below is not None:
+    _below[alert.symbol].add((alert.below, alert.id))
+
+
+def _Unindex(alert):
+  del _alerts[alert.id]
+  if alert.above is not None:
+    _above[alert.symbol].discard((alert.above, alert.id))
+  if alert.below is not None:
+    _below[alert.symbol].discard((alert.below, alert.id))
+
+
+def Create(user_id, symbol, above=None, below=None, percent=None, base=None):
+  """Store a new alert and start checking it.
+
+  Raises:
+    AlertLimitReached: If the user has too many alerts already.
+  """
+  if len(GetAlerts(user_id)) >= MAX_ALERTS_PER_USER:
+    raise AlertLimitReached()
+  symbol = symbol.upper()
+  with sql.GetCursor() as cursor:
+    cursor.execute(
+        'INSERT INTO alerts (user_id, symbol, above, below, percent, base) '
+        'VALUES (%s, %s, %s, %s, %s, %s)',
+        (user_id, symbol, above, below, percent, base))
+    alert = Alert(cursor.lastrowid, user_id, symbol, above, below, percent,
+                  base)
+  _Index(alert)
+  return alert
+
+
+def Delete(user_id, alert_id):
+  """Delete one of a user's alerts. Returns whether it existed."""
+  alert = _alerts.get(alert_id)
+  if alert is None or alert.user_id != user_id:
+    return False
+  _Unindex(alert)
+  with sql.GetCursor() as cursor:
+    cursor.execute('DELETE FROM alerts WHERE id = %s', (alert_id,))
+  return True
+
+
+def GetAlerts(user_id):
+  return sorted((alert for alert in _alerts.values()
+                 if alert.user_id == user_id), key=lambda alert: alert.id)
+
+
+def _Crossed(symbol, price):
+  """Alerts whose level price reached, in the order they were crossed."""
+  fired = []
+  above = _above.get(symbol)
+  if above:
+    end = above.bisect_right((price, float('inf')))
+    fired.extend(alert_id for _, alert_id in above[:end])
+  below = _below.get(symbol)
+  if below:
+    start = below.bisect_left((price, float('-inf')))
+    fired.extend(alert_id for _, alert_id in reversed(below[start:]))
+  return [_alerts[alert_id] for alert_id in fired]
+
+
+def OnTick(rows):
+  """coin_data tick listener: fire the alerts that rows' prices crossed."""
+  fired_by_user = collections.OrderedDict()
+  for symbol, price, timestamp in rows:
+    for alert in _Crossed(symbol, price):
+      _Unindex(alert)
+      fired_by_user.setdefault(alert.user_id, []).append((alert, price))
+  if not fired_by_user:
+    return
+  fired_ids = [alert.id for fired in fired_by_user.values()
+               for alert, _ in fired]
+  metrics.Increment('alerts.fired', len(fired_ids))
+  with sql.GetCursor() as cursor:
+    cursor.execute('DELETE FROM alerts WHERE id IN (%s)' %
+                   ', '.join(['%s'] * len(fired_ids)), fired_ids)
+  for user_id, fired in fired_by_user.items():
+    _Notify(user_id, '\n'.join(
+        'Alert: %s (now $%s)' % (alert.Describe(), price)
+        for alert, price in fired))
+
+
+def _GetQueue():
+  global _notifications
+  if _notifications is None:
+    _notifications = asyncio.Queue(MAX_PENDING_NOTIFICATIONS)
+  return _notifications
+
+
+def _Notify(user_id, text):
+  try:
+    _GetQueue().put_nowait((user_id, text))
+  except asyncio.QueueFull:
+    metrics.Increment('alerts.dropped')
+
+
+async def DeliverForever(send):
+  """Send queued notifications with send(user_id, text), rate limited."""
+  queue = _GetQueue()
+  while True:
+    user_id, text = await queue.get()
+    try:
+      await send(user_id, text)
+      metrics.Increment('alerts.delivered')
+    except Exception as e:
+      print('Exception delivering alert:\n%s' % (traceback.format_exc()))
+    await asyncio.sleep(1 / NOTIFICATIONS_PER_SECOND)
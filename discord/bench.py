@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+"""Benchmarks for the bot's hot paths against synthetic data.
+
+Prices for N coins x T ticks and K transactions for each of U users are
+generated deterministically from a seed and loaded into an in-process sqlite
+database standing in for MySQL, so runs are repeatable and need no server.
+Each operation's latency distribution and peak traced memory are printed and
+saved as json, and a previous run can be passed to --compare to spot
+regressions between commits.
+
+Example usage:
+  ./bench.py --output before.json
+  ./bench.py --output after.json --compare before.json
+"""
+import argparse
+import asyncio
+import json
+import platform
+import sqlite3
+import subprocess
+import time
+import tracemalloc
+import numpy as np
+import sql
+
+TICK_SECONDS = 300
+
+_SCHEMA = [
+    'CREATE TABLE coinhistory (symbol TEXT, price REAL, timestamp INTEGER, '
+    'PRIMARY KEY (symbol, timestamp))',
+    'CREATE INDEX coinhistory_timestamp ON coinhistory (timestamp)',
+    'CREATE TABLE ticks (timestamp INTEGER PRIMARY KEY)',
+    'CREATE TABLE transactions (user_id INTEGER, type TEXT, '
+    'timestamp INTEGER, in_symbol TEXT, in_amount REAL, out_symbol TEXT, '
+    'out_amount REAL)',
+    'CREATE INDEX transactions_user_id ON transactions (user_id)',
+]
+_ROLLUP_SCHEMA = (
+    'CREATE TABLE %s (symbol TEXT, bucket INTEGER, open REAL, '
+    'open_timestamp INTEGER, high REAL, low REAL, close REAL, '
+    'close_timestamp INTEGER, PRIMARY KEY (symbol, bucket))')
+
+
+class _User(object):
+  """Stands in for a discord.User in graphing."""
+
+  def __init__(self, user_id, name):
+    self.id = user_id
+    self.name = name
+
+  def __str__(self):
+    return self.name
+
+
+class _StandInCursor(object):
+  """Translates the bot's MySQL dialect for sqlite."""
+
+  _REWRITES = [('%s', '?'), ('START TRANSACTION', 'BEGIN'),
+               ('INSERT IGNORE', 'INSERT OR IGNORE')]
+
+  def __init__(self, cursor):
+    self._cursor = cursor
+
+  def _Translate(self, query):
+    for mysql, sqlite in self._REWRITES:
+      query = query.replace(mysql, sqlite)
+    return query
+
+  def execute(self, query, args=None):
+    self._cursor.execute(self._Translate(query), args or ())
+
+  def executemany(self, query, args):
+    self._cursor.executemany(self._Translate(query), args)
+
+  @property
+  def rowcount(self):
+    return self._cursor.rowcount
+
+  @property
+  def description(self):
+    return self._cursor.description
+
+  def fetchone(self):
+    return self._cursor.fetchone()
+
+  def fetchall(self):
+    return self._cursor.fetchall()
+
+  def fetchmany(self, size):
+    return self._cursor.fetchmany(size)
+
+  def close(self):
+    self._cursor.close()
+
+
+class _StandInConnection(object):
+  """The subset of a MySQLdb connection that sql.py uses, over sqlite."""
+
+  def __init__(self, uri):
+    self._db = sqlite3.connect(uri, uri=True, isolation_level=None,
+                               check_same_thread=False)
+
+  def cursor(self, cursorclass=None):
+    return _StandInCursor(self._db.cursor())
+
+  def autocommit(self, enabled):
+    pass
+
+  def ping(self, *args):
+    pass
+
+  def commit(self):
+    if self._db.in_transaction:
+      self._db.execute('COMMIT')
+
+  def rollback(self):
+    if self._db.in_transaction:
+      self._db.execute('ROLLBACK')
+
+  def close(self):
+    self._db.close()
+
+
+def GenerateMarket(coins, ticks, end, seed=0):
+  """Yields (symbol, prices, timestamps) random walks, one per coin."""
+  random = np.random.RandomState(seed)
+  timestamps = end - TICK_SECONDS*np.arange(ticks)[::-1]
+  for i in range(coins):
+    start_price = 10 ** random.uniform(-3, 4)
+    returns = random.normal(0, 0.004, ticks)
+    yield 'C%03d' % i, start_price * np.exp(np.cumsum(returns)), timestamps
+
+
+def GenerateTransactions(users, per_user, symbols, start, end, seed=0):
+  """Yields transactions table rows: an INIT, then buys, sells and trades."""
+  random = np.random.RandomState(seed)
+  for user_id in range(1, users + 1):
+    holdings = {}
+    times = np.sort(random.randint(start, end, per_user))
+    yield (user_id, 'INIT', int(times[0]), None, None, None, None)
+    for timestamp in times[1:]:
+      kind = random.choice(['BUY', 'BUY', 'SELL', 'TRADE'])
+      owned = [s for s, amount in holdings.items() if amount > 1e-6]
+      if kind != 'BUY' and owned:
+        out_symbol = owned[random.randint(len(owned))]
+        out_amount = holdings[out_symbol] * random.uniform(0.1, 0.9)
+        holdings[out_symbol] -= out_amount
+      else:
+        kind, out_symbol, out_amount = 'BUY', None, None
+      in_symbol, in_amount = None, None
+      if kind != 'SELL':
+        in_symbol = symbols[random.randint(len(symbols))]
+        in_amount = random.uniform(0.1, 100)
+        holdings[in_symbol] = holdings.get(in_symbol, 0) + in_amount
+      yield (user_id, kind, int(timestamp), in_symbol, in_amount,
+             out_symbol, out_amount)
+
+
+def SetUpDatabase(coins, ticks, users, per_user, end, seed):
+  """Creates and fills the stand-in database and points sql.py at it.
+
+  Returns:
+    The list of generated symbols.
+  """
+  import coin_data
+  import ingest
+  uri = 'file:bench%s?mode=memory&cache=shared' % seed
+  # Kept open for the lifetime of the process, or the database disappears.
+  SetUpDatabase.keepalive = _StandInConnection(uri)
+  db = SetUpDatabase.keepalive._db
+  for statement in _SCHEMA:
+    db.execute(statement)
+  for resolution in coin_data.RESOLUTIONS[1:]:
+    db.execute(_ROLLUP_SCHEMA % coin_data.ROLLUP_TABLES[resolution])
+
+  symbols = []
+  db.execute('BEGIN')
+  for symbol, prices, timestamps in GenerateMarket(coins, ticks, end, seed):
+    symbols.append(symbol)
+    rows = [(symbol, float(p), int(t)) for p, t in zip(prices, timestamps)]
+    db.executemany('INSERT INTO coinhistory VALUES (?, ?, ?)', rows)
+    for resolution in coin_data.RESOLUTIONS[1:]:
+      db.executemany(
+          'INSERT INTO %s VALUES (?, ?, ?, ?, ?, ?, ?, ?)' %
+          coin_data.ROLLUP_TABLES[resolution],
+          ingest.BuildRollupRows(rows, coin_data.ROLLUP_WIDTHS[resolution]))
+  db.execute('INSERT INTO ticks SELECT DISTINCT timestamp FROM coinhistory')
+  db.executemany(
+      'INSERT INTO transactions VALUES (?, ?, ?, ?, ?, ?, ?)',
+      GenerateTransactions(users, per_user, symbols,
+                           end - TICK_SECONDS*ticks, end, seed))
+  db.execute('COMMIT')
+  sql.UseConnectionFactory(lambda: _StandInConnection(uri))
+  return symbols
+
+
+def Measure(fn, repeat):
+  """Times repeat calls of fn, then measures one more under tracemalloc."""
+  latencies = []
+  for _ in range(repeat):
+    start = time.perf_counter()
+    fn()
+    latencies.append(time.perf_counter() - start)
+  tracemalloc.start()
+  fn()
+  _, peak = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  latencies = np.array(latencies) * 1000
+  return {
+      'n': repeat,
+      'mean_ms': float(latencies.mean()),
+      'p50_ms': float(np.percentile(latencies, 50)),
+      'p90_ms': float(np.percentile(latencies, 90)),
+      'max_ms': float(latencies.max()),
+      'peak_kb': peak / 1024.0,
+  }
+
+
+def RunBenchmarks(symbols, users, end, span, repeat, seed):
+  """Returns a dict of operation name to Measure results."""
+  import coin_data
+  import graph
+  import portfolio
+  import valuation
+  random = np.random.RandomState(seed)
+  start = end - span
+  t_list = list(range(start, end, span // 100)) + [end]
+  symbol = symbols[0]
+  results = {}
+
+  def ColdGetValue():
+    coin_data._coin_cache.Clear()
+    coin_data.GetHistory(symbol).GetValue(random.randint(start, end))
+  results['coin_get_value_cold'] = Measure(ColdGetValue, repeat)
+
+  history = coin_data.GetHistory(symbol)
+  history.GetValues(t_list)
+  history.GetValue(start)
+  results['coin_get_value_warm'] = Measure(
+      lambda: history.GetValue(random.randint(start, end)), repeat)
+  results['coin_get_values_101'] = Measure(
+      lambda: history.GetValues(t_list), repeat)
+
+  results['portfolio_load'] = Measure(
+      lambda: portfolio.PortfolioHistory(random.randint(1, users + 1)), repeat)
+
+  def BulkLoad():
+    portfolio._portfolios.Clear()
+    portfolio.LoadPortfolios(list(range(1, users + 1)))
+  results['portfolio_bulk_load_all_users'] = Measure(BulkLoad, repeat)
+  p = portfolio.GetPortfolio(1)
+  results['portfolio_init_from_transactions'] = Measure(
+      p.InitFromTransactions, repeat)
+  results['portfolio_buy'] = Measure(lambda: p.Buy(symbol, 1.0, end), repeat)
+
+  results['get_value_list_101'] = Measure(
+      lambda: p.GetValueList(t_list), repeat)
+  results['as_table'] = Measure(p.AsTable, repeat)
+
+  portfolios = [portfolio.GetPortfolio(i) for i in range(1, users + 1)]
+  results['value_matrix_all_users'] = Measure(
+      lambda: valuation.GetValueMatrix(portfolios, t_list), repeat)
+
+  graph_users = [_User(i, 'user%d' % i) for i in range(1, min(users, 10) + 1)]
+  loop = asyncio.new_event_loop()
+
+  def Graph():
+    graph._render_cache.Clear()
+    loop.run_until_complete(
+        graph.GraphPortfolioTimeSeries('Gainz', graph_users, start, end))
+  Graph()  # Starts the render workers.
+  results['graph_portfolio_time_series'] = Measure(Graph, repeat)
+  loop.close()
+  return results
+
+
+def _GitRevision():
+  try:
+    return subprocess.check_output(
+        ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def Compare(old, new):
+  """Prints each operation's p50 latency and peak memory against old's."""
+  print('%-34s %10s %10s %7s %10s' % (
+      'operation', 'old p50', 'new p50', 'ratio', 'peak kb'))
+  for name, result in sorted(new['results'].items()):
+    previous = old['results'].get(name)
+    if not previous:
+      continue
+    print('%-34s %9.3fms %9.3fms %6.2fx %10.1f' % (
+        name, previous['p50_ms'], result['p50_ms'],
+        result['p50_ms'] / max(previous['p50_ms'], 1e-9), result['peak_kb']))
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--coins', type=int, default=50)
+  parser.add_argument('--ticks', type=int, default=20000)
+  parser.add_argument('--users', type=int, default=50)
+  parser.add_argument('--transactions', type=int, default=40,
+                      help='Transactions per user.')
+  parser.add_argument('--repeat', type=int, default=20)
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--output', default='bench_results.json')
+  parser.add_argument('--compare', metavar='JSON',
+                      help='A previous --output to compare against.')
+  args = parser.parse_args()
+
+  # The data ends at the start of the current day so that "now" based
+  # commands see the latest generated tick.
+  end = int(time.time()) // 86400 * 86400
+  symbols = SetUpDatabase(args.coins, args.ticks, args.users,
+                          args.transactions, end, args.seed)
+  results = RunBenchmarks(symbols, args.users, end,
+                          TICK_SECONDS*args.ticks // 2, args.repeat, args.seed)
+  report = {
+      'revision': _GitRevision(),
+      'python': platform.python_version(),
+      'params': vars(args),
+      'results': results,
+  }
+  for name, result in sorted(results.items()):
+    print('%-34s p50 %9.3fms  p90 %9.3fms  peak %9.1fkb' % (
+        name, result['p50_ms'], result['p90_ms'], result['peak_kb']))
+  with open(args.output, 'w') as fp:
+    json.dump(report, fp, indent=2, sort_keys=True)
+  if args.compare:
+    with open(args.compare) as fp:
+      Compare(json.load(fp), report)
+
+
+if __name__ == '__main__':
+  main()
@@ -1,13 +1,31 @@
 #!/usr/bin/env python3
-import crypto_commands
-import general_commands
-import portfolio_commands
-import os
+import time
+_start_time = time.time()
+
 import util
 
-import discord
-from discord.ext import commands
-import coin_data
+# Imported through util.TimedImport so that startup cost can be broken down.
+# Plotting libraries are deliberately absent: graph.py only loads them inside
+# its render workers, the first time a graph is drawn.
+discord = util.TimedImport('discord')
+commands = util.TimedImport('discord.ext.commands')
+coin_data = util.TimedImport('coin_data')
+leaderboard = util.TimedImport('leaderboard')
+portfolio = util.TimedImport('portfolio')
+alerts = util.TimedImport('alerts')
+alert_commands = util.TimedImport('alert_commands')
+member_index = util.TimedImport('member_index')
+metrics = util.TimedImport('metrics')
+crypto_commands = util.TimedImport('crypto_commands')
+general_commands = util.TimedImport('general_commands')
+schedule_commands = util.TimedImport('schedule_commands')
+scheduler = util.TimedImport('scheduler')
+portfolio_commands = util.TimedImport('portfolio_commands')
+import os
+import traceback
+
+# Where metrics.py periodically dumps its json, relative to the working dir.
+METRICS_FILE = 'crypto_metrics.json'
 
 bot = commands.Bot(command_prefix='!' if os.name != 'nt' else '?', 
                    description="CryptoCurrency Bot")
@@ -18,10 +36,89 @@ async def on_ready():
   print(bot.user.name)
   print(bot.user.id)
   print('------')
+  print('Startup imports:\n%s' % util.GetImportReport())
+  print('Ready %.2fs after start' % (time.time() - _start_time))
+  print('------')
+
+# Keep the member name indexes current.
+@bot.event
+async def on_member_join(member):
+  member_index.AddMember(member)
+
+@bot.event
+async def on_member_remove(member):
+  member_index.RemoveMember(member)
+
+@bot.event
+async def on_member_update(before, after):
+  # Status, game and role changes don't affect the names that are indexed.
+  if (str(before) != str(after) or before.name != after.name or
+      before.display_name != after.display_name):
+    member_index.AddMember(after)
+
+@bot.event
+async def on_server_remove(server):
+  member_index.ForgetServer(server)
+
+# Commands are timed around Command.invoke rather than from an on_command
+# listener: listeners are dispatched as tasks, so they only run once the
+# command first awaits, after any synchronous work it did up front.
+_invoke = commands.Command.invoke
+
+async def _TimedInvoke(command, ctx):
+  start = time.perf_counter()
+  await _invoke(command, ctx)
+  metrics.Observe('command.%s' % command.qualified_name,
+                  time.perf_counter() - start)
+
+commands.Command.invoke = _TimedInvoke
+
+# A listener rather than an event, so the default error reporting still runs.
+@bot.listen()
+async def on_command_error(error, ctx):
+  if ctx.command is not None:
+    metrics.Increment('command.%s.errors' % ctx.command.qualified_name)
+
+async def _LoadLeaderboard():
+  # Only once logged in, so that reading every portfolio doesn't delay it.
+  await bot.wait_until_ready()
+  try:
+    leaderboard.Load()
+  except Exception as e:
+    print('Exception loading the leaderboard:\n%s' % (traceback.format_exc()))
+
+def main():
+  token = open(util.GetSettingsFilepath('crypto-bot-token')).read()
+  # Optionally warm start price histories from a snapshot.py export.
+  if os.path.exists(util.GetSettingsFilepath('crypto-snapshot')):
+    coin_data.LoadSnapshot(
+        open(util.GetSettingsFilepath('crypto-snapshot')).read().strip())
+  # Optionally read raw prices from a shared price_store.py directory.
+  if os.path.exists(util.GetSettingsFilepath('crypto-price-store')):
+    coin_data.UsePriceStore(
+        open(util.GetSettingsFilepath('crypto-price-store')).read().strip())
+  alerts.Load()
+  coin_data.AddTickListener(alerts.OnTick)
+  bot.loop.create_task(_LoadLeaderboard())
+  coin_data.AddTickListener(leaderboard.OnTick)
+  portfolio.AddChangeListener(leaderboard.OnPortfolioChanged)
+  bot.loop.create_task(leaderboard.SnapshotForever())
+  bot.loop.create_task(coin_data.TrackCoins())
+  bot.loop.create_task(metrics.DumpPeriodically(METRICS_FILE))
+  bot.add_cog(crypto_commands.Crypto(bot))
+  bot.add_cog(portfolio_commands.Portfolio(bot))
+  bot.add_cog(general_commands.General(bot))
+  alert_cog = alert_commands.Alerts(bot)
+  bot.add_cog(alert_cog)
+  bot.loop.create_task(alerts.DeliverForever(alert_cog.Deliver))
+  scheduler.Load()
+  schedule_cog = schedule_commands.Schedule(bot)
+  bot.add_cog(schedule_cog)
+  bot.loop.create_task(scheduler.RunForever(schedule_cog.RunBatch))
+  bot.run(token)
+
 
-token = open(util.GetSettingsFilepath('crypto-bot-token')).read()
-bot.loop.create_task(coin_data.TrackCoins())
-bot.add_cog(crypto_commands.Crypto(bot))
-bot.add_cog(portfolio_commands.Portfolio(bot))
-bot.add_cog(general_commands.General(bot))
-bot.run(token)
+# graph.py's render workers re-import this file on platforms that spawn
+# processes (Windows, macOS), where it must not start a second bot.
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,154 @@
+"""A bounded LRU cache with optional TTLs, shared by the data caches.
+
+Example usage:
+  _histories = cache.Cache(max_bytes=64*2**20, sizeof=lambda h: h.nbytes)
+  history = _histories.Get('BTC', LoadHistory)
+"""
+import collections
+import time
+
+
+class _Entry(object):
+
+  def __init__(self, value, size, expires, negative):
+    self.value = value
+    self.size = size
+    self.expires = expires
+    self.negative = negative
+
+
+class Cache(object):
+  """Maps keys to lazily loaded values, evicting the least recently used.
+
+  Budgets can be given as a number of entries, a number of bytes (measured
+  by sizeof), or both. Since cached values may grow after they are loaded,
+  an entry's size is re-measured every time it is accessed.
+
+  Loaded values that is_negative considers "not found" are cached too, but
+  only for negative_ttl seconds, so that repeated lookups of unknown keys
+  don't each go back to the database.
+  """
+
+  def __init__(self, max_entries=None, max_bytes=None, ttl=None,
+               negative_ttl=300, sizeof=None, is_negative=None,
+               clock=time.time):
+    self._entries = collections.OrderedDict()
+    self._max_entries = max_entries
+    self._max_bytes = max_bytes
+    self._ttl = ttl
+    self._negative_ttl = negative_ttl
+    self._sizeof = sizeof or (lambda value: 0)
+    self._is_negative = is_negative or (lambda value: False)
+    self._clock = clock
+    self._bytes = 0
+    self.hits = 0
+    self.negative_hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.expirations = 0
+
+  def Configure(self, max_entries=None, max_bytes=None, ttl=None):
+    """Change the budgets; the cache is shrunk to fit immediately."""
+    self._max_entries = max_entries
+    self._max_bytes = max_bytes
+    self._ttl = ttl
+    self._Shrink()
+
+  def __len__(self):
+    return len(self._entries)
+
+  def __contains__(self, key):
+    return self.Peek(key) is not None
+
+  def Get(self, key, loader=None):
+    """Returns the value for key, calling loader(key) on a miss.
+
+    Without a loader a miss returns None.
+    """
+    entry = self._entries.get(key)
+    if entry is not None and self._Expired(entry):
+      self.expirations += 1
+      self.Invalidate(key)
+      entry = None
+    if entry is not None:
+      if entry.negative:
+        self.negative_hits += 1
+      else:
+        self.hits += 1
+      self._entries.move_to_end(key)
+      self._Resize(entry, self._sizeof(entry.value))
+    else:
+      self.misses += 1
+      if loader is None:
+        return None
+      entry = self._Put(key, loader(key))
+    self._Shrink()
+    return entry.value
+
+  def Put(self, key, value):
+    self._Put(key, value)
+    self._Shrink()
+
+  def Peek(self, key):
+    """Returns the cached value for key or None, without counting an access."""
+    entry = self._entries.get(key)
+    if entry is None or self._Expired(entry):
+      return None
+    return entry.value
+
+  def IsNegative(self, key):
+    entry = self._entries.get(key)
+    return entry is not None and entry.negative
+
+  def Invalidate(self, key):
+    entry = self._entries.pop(key, None)
+    if entry is not None:
+      self._bytes -= entry.size
+
+  def Clear(self):
+    self._entries.clear()
+    self._bytes = 0
+
+  def Keys(self):
+    return list(self._entries.keys())
+
+  def Stats(self):
+    return {
+        'entries': len(self._entries),
+        'bytes': self._bytes,
+        'hits': self.hits,
+        'negative_hits': self.negative_hits,
+        'misses': self.misses,
+        'evictions': self.evictions,
+        'expirations': self.expirations,
+    }
+
+  def _Put(self, key, value):
+    self.Invalidate(key)
+    negative = self._is_negative(value)
+    ttl = self._negative_ttl if negative else self._ttl
+    expires = self._clock() + ttl if ttl is not None else None
+    entry = _Entry(value, 0, expires, negative)
+    self._entries[key] = entry
+    self._Resize(entry, self._sizeof(value))
+    return entry
+
+  def _Resize(self, entry, size):
+    self._bytes += size - entry.size
+    entry.size = size
+
+  def _Expired(self, entry):
+    return entry.expires is not None and entry.expires <= self._clock()
+
+  def _OverBudget(self):
+    return ((self._max_entries is not None and
+             len(self._entries) > self._max_entries) or
+            (self._max_bytes is not None and self._bytes > self._max_bytes))
+
+  def _Shrink(self):
+    # The most recently used entry is always kept, even if it alone is over
+    # the byte budget, since the caller is about to use it.
+    while len(self._entries) > 1 and self._OverBudget():
+      key, entry = self._entries.popitem(last=False)
+      self._bytes -= entry.size
+      self.evictions += 1
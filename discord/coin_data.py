@@ -1,84 +1,435 @@
 """Logic for dealing with coin data / prices over time. """
-from sortedcontainers import SortedDict
-import coinmarketcap
+import numpy as np
 import traceback
 import asyncio
+import cache
+import metrics
 import sql
-import time
 from datetime import datetime, timedelta
 
-_coin_cache = {}
+# Keyed by (symbol, resolution). Symbols without any data are negative-cached
+# so that typos don't hit the database on every lookup.
+COIN_CACHE_BYTES = 256*2**20
+# Each memory-mapped history holds a file descriptor open, so at most this
+# many of them are cached at once (see _MappedPriceHistory.nbytes).
+MAX_MAPPED_HISTORIES = 256
+_coin_cache = cache.Cache(
+    max_bytes=COIN_CACHE_BYTES, sizeof=lambda history: history.nbytes,
+    is_negative=lambda history: not history.Exists())
+metrics.RegisterGauge('coin_cache', _coin_cache.Stats)
+
+# Price series are kept at several resolutions. Raw is every tick written by
+# ingest.py; the rollups hold one OHLC row per symbol per bucket, keyed by the
+# bucket's start time and updated as ticks arrive.
+RAW = 'raw'
+HOURLY = 'hourly'
+DAILY = 'daily'
+# Ordered finest to coarsest.
+RESOLUTIONS = [RAW, HOURLY, DAILY]
+ROLLUP_WIDTHS = {HOURLY: 3600, DAILY: 86400}
+ROLLUP_TABLES = {HOURLY: 'coinhistory_hourly', DAILY: 'coinhistory_daily'}
+
+# How often the bot checks the database for ticks written by ingest.py.
+FOLLOW_INTERVAL = 30
+
+# Timestamp of the newest tick TrackCoins has seen.
+_last_tick_timestamp = None
+
+# A snapshot.Snapshot that raw histories are seeded from, if one is loaded.
+_snapshot = None
+
+# A price_store.PriceStore that raw histories are read from instead of the
+# database, if one is in use.
+_price_store = None
+
+# Functions called with each batch of new (symbol, price, timestamp) rows.
+_tick_listeners = []
 
 
-# TODO(brandonsalmon): Move TrackCoins to a different executable so that we
-# reduce the likelihood of having price data gaps.
 async def TrackCoins():
-  await asyncio.sleep(100)
+  """Follow the ticks that ingest.py writes and push them into the cache.
+
+  The bot process never talks to coinmarketcap or writes price data itself;
+  it only reads back what the ingestion daemon stored. The queries run in an
+  executor thread so they never hold up the event loop.
+  """
+  global _last_tick_timestamp
+  loop = asyncio.get_event_loop()
   while True:
     try:
-      _DownloadNewDataPoint()
-      _coin_cache.clear()
+      if _last_tick_timestamp is None:
+        _last_tick_timestamp = await loop.run_in_executor(
+            None, _LatestTimestamp)
+      else:
+        with metrics.Timer('coin_data.follow'):
+          rows = await loop.run_in_executor(
+              None, _ReadTicksSince, _last_tick_timestamp)
+          _AppendToCache(rows)
+        metrics.Increment('coin_data.followed_rows', len(rows))
+        if rows:
+          _last_tick_timestamp = rows[-1][2]
+          _NotifyTickListeners(rows)
+    except Exception as e:
+      print('Exception in TrackCoins:\n%s' % (traceback.format_exc()))
+    await asyncio.sleep(FOLLOW_INTERVAL)
+
+
+def AddTickListener(fn):
+  """Call fn(rows) with the (symbol, price, timestamp) rows of new ticks.
+
+  Listeners run on the event loop after the cache has been updated, in the
+  order they were added. One failing doesn't stop the others.
+  """
+  _tick_listeners.append(fn)
+
+
+def _NotifyTickListeners(rows):
+  for fn in _tick_listeners:
+    try:
+      fn(rows)
     except Exception as e:
-      print('Exception in UpdateCoins:\n%s' % (traceback.format_exc()))
-    await asyncio.sleep(300)
+      print('Exception in tick listener:\n%s' % (traceback.format_exc()))
+
+
+def LoadSnapshot(path):
+  """Seed raw histories from a snapshot file (see snapshot.py).
+
+  Histories created afterwards start out with everything up to the
+  snapshot's cutoff and only query the database for newer rows.
+  """
+  global _snapshot
+  import snapshot
+  _snapshot = snapshot.Snapshot(path)
+  for key in _coin_cache.Keys():
+    if key[1] == RAW:
+      _coin_cache.Invalidate(key)
+
+
+def UsePriceStore(directory):
+  """Read raw histories from a memory-mapped price_store directory."""
+  global _price_store
+  import price_store
+  _price_store = price_store.PriceStore(directory)
+  for key in _coin_cache.Keys():
+    if key[1] == RAW:
+      _coin_cache.Invalidate(key)
+
 
+def GetLastTickTimestamp():
+  """The newest tick the bot has seen, which versions all cached prices."""
+  return _last_tick_timestamp
 
-def GetHistory(symbol):
-  if not symbol.upper() in _coin_cache:
-    _coin_cache[symbol.upper()] = _CoinPriceHistory(symbol.upper())
-  return _coin_cache[symbol.upper()]
 
+def GetHistory(symbol, resolution=RAW):
+  return _coin_cache.Get((symbol.upper(), resolution), _LoadHistory)
 
 
-def _DownloadNewDataPoint():
-  market = coinmarketcap.Market()
-  cmc_dict = market.ticker(limit=0)
+def _LoadHistory(key):
+  symbol, resolution = key
+  if resolution == RAW and _price_store is not None:
+    return _MappedPriceHistory(symbol, _price_store)
+  return _CoinPriceHistory(symbol, resolution)
 
+
+def GetHistoryForRange(symbol, start_t, end_t, points=100):
+  """Get the coarsest history that can still answer a range query.
+
+  Args:
+    symbol: A cryptocurrency symbol.
+    start_t: Unix timestamp of the start of the range.
+    end_t: Unix timestamp of the end of the range.
+    points: How many evenly spaced points the caller will sample.
+  """
+  return GetHistory(symbol, SelectResolution(start_t, end_t, points))
+
+
+def SelectResolution(start_t, end_t, points=100):
+  """The coarsest resolution whose buckets fit between sampled points."""
+  step = (end_t - start_t) / max(points, 1)
+  selected = RAW
+  for resolution in RESOLUTIONS[1:]:
+    if ROLLUP_WIDTHS[resolution] <= step:
+      selected = resolution
+  return selected
+
+
+def _AppendToCache(rows):
+  """Push freshly written (symbol, price, timestamp) rows into the cache.
+
+  Only histories that are already in memory are touched; anything else will
+  be loaded from the database the first time it is asked for.
+  """
+  for symbol, price, timestamp in rows:
+    for resolution in RESOLUTIONS:
+      key = (symbol, resolution)
+      if _coin_cache.IsNegative(key):
+        # A newly listed coin; let the next lookup load it properly.
+        _coin_cache.Invalidate(key)
+      elif key in _coin_cache:
+        _coin_cache.Peek(key).Append(timestamp, price)
+
+
+def _LatestTimestamp():
   with sql.GetCursor() as cursor:
-    for coin in sorted(cmc_dict, key=lambda d: int(d["rank"])):
-      if coin["price_usd"]:
-        try:
-          cursor.execute(
-              'insert into coinhistory (symbol, price, timestamp) values '
-              '("%s", %s, %s)' % (coin["symbol"].upper(),
-                                  float(coin["price_usd"].replace(',','')), 
-                                  int(time.time())))
-        except Exception as e: 
-          if not "Duplicate entry" in str(e):
-            raise
+    cursor.execute('SELECT MAX(timestamp) FROM ticks')
+    return cursor.fetchone()[0] or 0
 
 
+def _ReadTicksSince(timestamp):
+  """Returns (symbol, price, timestamp) rows newer than timestamp, in order.
 
-class _CoinPriceHistory(SortedDict):
+  The small ticks table that ingest.py writes says which ticks are new, so
+  coinhistory is only read when there is something to read, and then only
+  at those timestamps.
+  """
+  with sql.GetCursor() as cursor:
+    cursor.execute(
+        'SELECT timestamp FROM ticks WHERE timestamp > %s ORDER BY timestamp',
+        (timestamp,))
+    tick_timestamps = [row[0] for row in cursor.fetchall()]
+    if not tick_timestamps:
+      return []
+    cursor.execute(
+        'SELECT symbol, price, timestamp FROM coinhistory '
+        'WHERE timestamp IN (%s) ORDER BY timestamp' %
+        ', '.join(['%s'] * len(tick_timestamps)), tick_timestamps)
+    return list(cursor.fetchall())
+
+
+class _CoinPriceHistory(object):
   """The historical price data for a coin.
 
+  Prices are held as two parallel, sorted columns (int64 timestamps and
+  float64 prices) so that a coin with years of 5 minute ticks costs 16 bytes
+  per tick instead of a pair of boxed python objects.
+
+  Nothing but the latest row is read up front. Lookups before it fetch just
+  the time ranges they touch with BETWEEN queries and merge them into the
+  columns, so !price never reads more than one row and !history only reads
+  around the two points it compares.
+
+  For a rollup resolution the series is the close of each bucket, stamped
+  with the time of the tick that closed it, so lookups keep the "last known
+  price at or before t" meaning of the raw series, just sampled more sparsely.
+  The newest point is always the latest tick.
+
   Usually this class should only be instantiated by GetHistory.
   """
 
-  def __init__(self, symbol):
-    super(_CoinPriceHistory, self).__init__()
+  def __init__(self, symbol, resolution=RAW):
     self._symbol = symbol.upper()
+    self._resolution = resolution
+    if resolution == RAW:
+      self._table, self._time_column, self._price_column = (
+          'coinhistory', 'timestamp', 'price')
+    else:
+      self._table, self._time_column, self._price_column = (
+          ROLLUP_TABLES[resolution], 'close_timestamp', 'close')
+    # Sorted, disjoint [start, end] ranges for which the columns hold every
+    # row (bar the latest one, which is kept in self._latest). Each range
+    # starts at a row, or at -inf if there are no earlier rows, so any
+    # lookup inside a range is exact.
+    self._loaded_ranges = []
+    self._SetColumns(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64))
+    if resolution == RAW and _snapshot is not None:
+      self._LoadSnapshot(_snapshot)
+    self._latest = self._FetchLatest()
+
+  def _LoadSnapshot(self, snapshot):
+    # The snapshot holds every row up to its cutoff, so a symbol that isn't
+    # in it had no rows before then, unless it couldn't be stored at all.
+    if not snapshot.Covers(self.GetSymbol()):
+      return
+    if self.GetSymbol() in snapshot:
+      timestamps, prices = snapshot.Get(self.GetSymbol())
+      self._SetColumns(timestamps, prices.astype(np.float64, copy=False))
+    self._AddLoadedRange(float('-inf'), snapshot.GetCutoff())
+
+  def _SetColumns(self, timestamps, prices):
+    # The columns are over-allocated so that Append is amortized O(1);
+    # _timestamps and _prices are views of the filled prefix.
+    self._timestamp_buffer = timestamps
+    self._price_buffer = prices
+    self._size = len(timestamps)
+    self._UpdateViews()
+
+  def _UpdateViews(self):
+    self._timestamps = self._timestamp_buffer[:self._size]
+    self._prices = self._price_buffer[:self._size]
+
+  def _FetchLatest(self):
+    """Returns the newest (timestamp, price) row, or None if there is none."""
     with sql.GetCursor() as cursor:
       cursor.execute(
-          'SELECT timestamp, price FROM coinhistory '
-          'where symbol = "%s"' % self.GetSymbol())
-      for t in cursor.fetchall():
-        self[t[0]] = t[1]
+          'SELECT %s, %s FROM %s WHERE symbol = %%s '
+          'ORDER BY %s DESC LIMIT 1' % (
+              self._time_column, self._price_column, self._table,
+              self._time_column),
+          (self.GetSymbol(),))
+      row = cursor.fetchone()
+    return (int(row[0]), float(row[1])) if row else None
+
+  def _FetchRange(self, start, end):
+    """Returns the rows in [start, end] plus the last row before start.
+
+    Returns:
+      A tuple of int64 timestamp and float64 price numpy arrays.
+    """
+    with sql.GetCursor(streaming=True) as cursor:
+      cursor.execute(
+          'SELECT {time}, {price} FROM {table} WHERE symbol = %s AND {time} '
+          'BETWEEN COALESCE((SELECT MAX({time}) FROM {table} '
+          'WHERE symbol = %s AND {time} <= %s), %s) AND %s '
+          'ORDER BY {time}'.format(
+              time=self._time_column, price=self._price_column,
+              table=self._table),
+          (self.GetSymbol(), self.GetSymbol(), start, start, end))
+      return sql.FetchColumns(cursor)
+
+  def _EnsureLoaded(self, start, end):
+    """Makes sure every row in [start, end] is in the columns."""
+    if self._latest is None:
+      return
+    start, end = float(start), float(min(end, self._latest[0] - 1))
+    if start > end:
+      return
+    for gap_start, gap_end in self._Gaps(start, end):
+      timestamps, prices = self._FetchRange(gap_start, gap_end)
+      if len(timestamps) and timestamps[0] <= gap_start:
+        range_start = int(timestamps[0])
+      else:
+        range_start = float('-inf')
+      self._MergeRows(timestamps, prices)
+      self._AddLoadedRange(range_start, gap_end)
+
+  def _Gaps(self, start, end):
+    """The parts of [start, end] that aren't in a loaded range."""
+    gaps = []
+    for range_start, range_end in self._loaded_ranges:
+      if range_end < start:
+        continue
+      if range_start > end:
+        break
+      if range_start > start:
+        gaps.append((start, range_start))
+      if range_end >= end:
+        return gaps
+      start = range_end
+    gaps.append((start, end))
+    return gaps
+
+  def _MergeRows(self, timestamps, prices):
+    timestamps = np.concatenate([self._timestamps, timestamps])
+    prices = np.concatenate([self._prices, prices])
+    # mergesort is stable, so existing rows win over refetched duplicates.
+    order = np.argsort(timestamps, kind='mergesort')
+    timestamps = timestamps[order]
+    prices = prices[order]
+    unique = np.ones(len(timestamps), dtype=bool)
+    unique[1:] = timestamps[1:] != timestamps[:-1]
+    self._SetColumns(timestamps[unique], prices[unique])
+
+  def _AddLoadedRange(self, start, end):
+    merged = []
+    for range_start, range_end in sorted(self._loaded_ranges + [(start, end)]):
+      if merged and range_start <= merged[-1][1]:
+        merged[-1] = (merged[-1][0], max(merged[-1][1], range_end))
+      else:
+        merged.append((range_start, range_end))
+    self._loaded_ranges = merged
+
+  def _PushColumns(self, timestamp, price):
+    if self._size == len(self._timestamp_buffer):
+      capacity = max(16, 2*self._size)
+      self._timestamp_buffer = np.resize(self._timestamp_buffer, capacity)
+      self._price_buffer = np.resize(self._price_buffer, capacity)
+    self._timestamp_buffer[self._size] = timestamp
+    self._price_buffer[self._size] = price
+    self._size += 1
+    self._UpdateViews()
+
+  def __len__(self):
+    """The number of rows currently held in memory."""
+    return self._size
+
+  @property
+  def nbytes(self):
+    return self._timestamp_buffer.nbytes + self._price_buffer.nbytes
+
+  def Exists(self):
+    return self._latest is not None
+
+  def Append(self, timestamp, price):
+    """Adds a tick newer than every tick already in the history.
+
+    Ticks at or before the latest known timestamp are ignored, since they are
+    duplicates. For rollups a tick in the same bucket as the latest point
+    replaces it as the close.
+    """
+    if self._latest is None:
+      # There were no rows before this one.
+      self._AddLoadedRange(float('-inf'), timestamp)
+      self._latest = (timestamp, price)
+      return
+    latest_timestamp, latest_price = self._latest
+    if timestamp <= latest_timestamp:
+      return
+    if self._resolution != RAW:
+      width = ROLLUP_WIDTHS[self._resolution]
+      if timestamp // width == latest_timestamp // width:
+        self._latest = (timestamp, price)
+        return
+    # The previous latest row becomes part of the series, and nothing can
+    # have been written between it and this tick.
+    if not self._size or latest_timestamp > self._timestamps[-1]:
+      self._PushColumns(latest_timestamp, latest_price)
+    self._AddLoadedRange(latest_timestamp, timestamp)
+    self._latest = (timestamp, price)
 
   def GetSymbol(self):
     return self._symbol
 
+  def GetResolution(self):
+    return self._resolution
+
   def GetValue(self, timestamp=None):
-    try:
-      if timestamp:
-        bisect_point = self.bisect(timestamp)
-        if(bisect_point) is 0:
-          return 0.0
-        return self[self._list[bisect_point-1]]
-      else:
-        return self[self._list[-1]]
-    except (IndexError, KeyError):
+    if self._latest is None:
       return 0.0
+    if not timestamp or timestamp >= self._latest[0]:
+      return self._latest[1]
+    self._EnsureLoaded(timestamp, timestamp)
+    bisect_point = int(np.searchsorted(
+        self._timestamps, timestamp, side='right'))
+    if bisect_point == 0:
+      return 0.0
+    return float(self._prices[bisect_point-1])
+
+  def GetValues(self, timestamps):
+    """Batched GetValue.
+
+    Args:
+      timestamps: An iterable of unix timestamps.
+
+    Returns:
+      A float64 numpy array with the price at each timestamp, 0.0 where
+      there is no data at or before that timestamp.
+    """
+    timestamps = np.asarray(timestamps)
+    if self._latest is None or not len(timestamps):
+      return np.zeros(len(timestamps), dtype=np.float64)
+    latest_timestamp, latest_price = self._latest
+    historical = timestamps < latest_timestamp
+    if historical.any():
+      self._EnsureLoaded(timestamps[historical].min(),
+                         timestamps[historical].max())
+    bisect_points = np.searchsorted(self._timestamps, timestamps, side='right')
+    if self._size:
+      values = self._prices[np.maximum(bisect_points - 1, 0)]
+    else:
+      values = np.zeros(len(timestamps), dtype=np.float64)
+    values[bisect_points == 0] = 0.0
+    values[~historical] = latest_price
+    return values
 
   def GetDayChange(self, timestamp=None):
     currentVal = self.GetValue(timestamp)
@@ -90,3 +441,71 @@ class _CoinPriceHistory(SortedDict):
     if oldVal is None:
       return None
     return 100*((currentVal - oldVal) / oldVal)
+
+
+class _MappedPriceHistory(object):
+  """The raw price history of a coin, read from a memory-mapped price store.
+
+  Lookups are binary searches straight over the mapped file, so the data
+  lives in the shared page cache rather than in this process. Offers the same
+  interface as _CoinPriceHistory.
+
+  Usually this class should only be instantiated by GetHistory.
+  """
+
+  def __init__(self, symbol, store):
+    self._symbol = symbol.upper()
+    self._series = store.Open(self._symbol)
+    # A tick the follower has seen that ingest.py hasn't appended to the
+    # store yet.
+    self._pending = None
+
+  def __len__(self):
+    return len(self._series)
+
+  @property
+  def nbytes(self):
+    # The mapping is shared page cache, not memory owned by this process,
+    # but its file descriptor is. A nominal size keeps the number of open
+    # mappings bounded.
+    return COIN_CACHE_BYTES // MAX_MAPPED_HISTORIES
+
+  def Exists(self):
+    return self._Latest() is not None
+
+  def Append(self, timestamp, price):
+    self._series.Refresh()
+    latest = self._series.Last()
+    if latest is None or timestamp > latest[0]:
+      self._pending = (timestamp, price)
+
+  def _Latest(self):
+    latest = self._series.Last()
+    if self._pending and (latest is None or self._pending[0] > latest[0]):
+      return self._pending
+    return latest
+
+  def GetSymbol(self):
+    return self._symbol
+
+  def GetResolution(self):
+    return RAW
+
+  def GetValue(self, timestamp=None):
+    latest = self._Latest()
+    if latest is None:
+      return 0.0
+    if not timestamp or timestamp >= latest[0]:
+      return latest[1]
+    return float(self._series.GetValues([timestamp])[0])
+
+  def GetValues(self, timestamps):
+    timestamps = np.asarray(timestamps)
+    values = self._series.GetValues(timestamps)
+    latest = self._Latest()
+    if latest is not None:
+      values[timestamps >= latest[0]] = latest[1]
+    return values
+
+  def GetDayChange(self, timestamp=None):
+    return _CoinPriceHistory.GetDayChange(self, timestamp)
@@ -4,6 +4,35 @@ import datetime
 import meme_helper
 import coin_data
 
+
+def FormatHistory(symbol, time_str, now=None):
+  """The text of !history for symbol over the time_str before now.
+
+  Args:
+    symbol: A cryptocurrency symbol.
+    time_str: A time string understood by util.GetTimeDelta.
+    now: Unix timestamp of the end of the window (default: now).
+  """
+  td = util.GetTimeDelta(time_str)
+  end = datetime.datetime.fromtimestamp(now) if now else datetime.datetime.now()
+  past_time = end - td
+  # The newest point of every resolution is the latest tick, so the coarsest
+  # history that spans the window answers both ends of it.
+  history = coin_data.GetHistoryForRange(
+      symbol, past_time.timestamp(), end.timestamp())
+  val_old = history.GetValue(past_time.timestamp())
+  val = history.GetValue(now)
+  if val_old is None:
+    return 'No data for %s %s ago.' % (symbol.upper(), time_str)
+  elif val is not None:
+    change = ((val-val_old) / val_old) * 100
+    txt = '%s is currently at $%.2f (%.2f%s in the past %s)' % (
+               symbol.upper(), val, change, "%", time_str)
+    return meme_helper.PossiblyAddMemeToTxt(txt, symbol.upper(), change, td)
+  else:
+    return 'Unknown symbol %s.' % symbol.upper()
+
+
 class Crypto(object):
   """Commands for checking the value of / interacting with cryptocurrencies."""
 
@@ -30,19 +59,4 @@ class Crypto(object):
     """
     if not time_str:
       time_str = ['24', 'hours']
-    time_str = ' '.join(time_str)
-    td = util.GetTimeDelta(time_str)
-    past_time = datetime.datetime.now() - td
-    history = coin_data.GetHistory(symbol)
-    val_old = history.GetValue(past_time.timestamp())
-    val = history.GetValue()
-    if val_old is None:
-      await self.bot.say('No data for %s %s ago.' % (symbol.upper(), time_str))
-    elif val is not None:
-      change = ((val-val_old) / val_old) * 100
-      txt = '%s is currently at $%.2f (%.2f%s in the past %s)' % (
-                 symbol.upper(), val, change, "%", time_str)
-      await self.bot.say(
-          meme_helper.PossiblyAddMemeToTxt(txt, symbol.upper(), change, td))
-    else:
-      await self.bot.say('Unknown symbol %s.' % symbol.upper())
+    await self.bot.say(FormatHistory(symbol, ' '.join(time_str)))
@@ -1,5 +1,6 @@
 import discord
 from discord.ext import commands
+import metrics
 import random
 
 class General(object):
@@ -24,3 +25,19 @@ class General(object):
   async def choose(self, *choices : str):
     """Chooses between multiple choices."""
     await self.bot.say(random.choice(choices))
+
+  @commands.command()
+  @commands.has_permissions(administrator=True)
+  async def stats(self, prefix=None):
+    """Show command, database and cache metrics. Admins only.
+
+    example: !stats sql
+    """
+    message = ''
+    for line in metrics.Format(prefix).split('\n'):
+      # Stay under discord's 2000 character message limit.
+      if len(message) + len(line) > 1900:
+        await self.bot.say('```%s```' % message)
+        message = ''
+      message += line + '\n'
+    await self.bot.say('```%s```' % message)
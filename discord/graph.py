@@ -1,42 +1,179 @@
-import matplotlib
-# Force matplotlib to not use any Xwindows backend.
-matplotlib.use('Agg')
-import seaborn as sns
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
-import pandas as pd
+"""Graphing of portfolio values over time.
+
+Values are computed in the bot process, but drawing happens in a small pool
+of worker processes so that matplotlib never runs on the event loop. Figures
+are returned as PNG bytes rather than written to a shared file.
+
+matplotlib is only ever imported by the workers, so the bot process starts
+(and answers commands) without loading the plotting stack.
+"""
+import numpy as np
+import asyncio
+import concurrent.futures
 import datetime
-import os
+import io
+import cache
+import coin_data
+import metrics
 import portfolio
+import valuation
+
+# Number of processes drawing graphs at once.
+MAX_RENDER_WORKERS = 2
+# Graphs allowed to be drawing or waiting to draw before new ones are refused.
+MAX_PENDING_RENDERS = 8
+# Series longer than this are decimated before drawing.
+MAX_POINTS_PER_SERIES = 500
+
+_executor = None
+# The figure, axes and line artists of this worker process, reused between
+# renders. See _GetFigure.
+_figure = None
+_render_stats = {'pending': 0, 'rendered': 0, 'rejected': 0}
+
+# Encoded PNGs keyed by what went into them, including a data version made
+# of the last tick and each portfolio's revision. New prices or transactions
+# change the key, so stale graphs are never served and simply age out.
+_render_cache = cache.Cache(max_bytes=32*2**20, sizeof=len)
+# Renders in progress by cache key, so identical concurrent requests share one.
+_inflight = {}
+
+
+class RenderQueueFull(Exception):
+  """Too many graphs are already waiting to be drawn."""
+
+
+def GetRenderStats():
+  """The render queue depth ('pending') and completed/rejected counts."""
+  stats = dict(_render_stats)
+  stats['cache'] = _render_cache.Stats()
+  return stats
+
+
+metrics.RegisterGauge('graph', GetRenderStats)
+
+
+async def GraphPortfolioTimeSeries(title, users, start_t, end_t):
+  """Graph the value of users' portfolios between two timestamps.
+
+  The window ends at the latest tick, since there is no newer data, and its
+  start is rounded down to the graph's grid step, so that repeated requests
+  between two ticks can be served from the cache.
+
+  Returns:
+    The graph as PNG encoded bytes.
+
+  Raises:
+    RenderQueueFull: If MAX_PENDING_RENDERS graphs are already queued.
+  """
+  last_tick = coin_data.GetLastTickTimestamp()
+  if last_tick:
+    end_t = min(end_t, last_tick)
+  start_t = min(start_t, end_t)
+  step = max((end_t-start_t)//100, 1)
+  start_t -= start_t % step
+  portfolios = [portfolio.GetPortfolio(user.id) for user in users]
+  labels = ['%s' % user for user in users]
+  key = (title, tuple(labels), tuple(user.id for user in users),
+         start_t, end_t, step, coin_data.GetLastTickTimestamp(),
+         tuple(p.GetRevision() for p in portfolios))
+
+  png = _render_cache.Get(key)
+  if png is not None:
+    return png
+  if key in _inflight:
+    return await asyncio.shield(_inflight[key])
+  future = asyncio.ensure_future(
+      _Render(title, labels, portfolios, start_t, end_t, step))
+  _inflight[key] = future
+  try:
+    png = await asyncio.shield(future)
+  finally:
+    _inflight.pop(key, None)
+  _render_cache.Put(key, png)
+  return png
+
+
+async def _Render(title, labels, portfolios, start_t, end_t, step):
+  global _executor
+  if _render_stats['pending'] >= MAX_PENDING_RENDERS:
+    _render_stats['rejected'] += 1
+    raise RenderQueueFull()
+  t_list = list(range(start_t, end_t, step)) + [end_t]
+  with metrics.Timer('graph.valuation'):
+    value_matrix = valuation.GetValueMatrix(portfolios, t_list)
+
+  if _executor is None:
+    _executor = concurrent.futures.ProcessPoolExecutor(MAX_RENDER_WORKERS)
+  _render_stats['pending'] += 1
+  try:
+    # Includes time spent queued behind other renders.
+    with metrics.Timer('graph.render'):
+      png = await asyncio.get_event_loop().run_in_executor(
+          _executor, _RenderTimeSeries, title, labels, t_list, value_matrix)
+  finally:
+    _render_stats['pending'] -= 1
+  _render_stats['rendered'] += 1
+  return png
+
+
+def _GetFigure():
+  global _figure
+  if _figure is None:
+    import matplotlib
+    # Force matplotlib to not use any Xwindows backend.
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import matplotlib.dates as mdates
+    fig, ax = plt.subplots()
+    # assign locator for the xaxis ticks.
+    ax.xaxis.set_major_locator(mdates.AutoDateLocator())
+    _figure = (fig, ax, [])
+  return _figure
+
+
+def _Decimate(x_values, y_values, max_points):
+  """Thin a series to about max_points, keeping each stretch's min and max."""
+  if len(y_values) <= max_points:
+    return x_values, y_values
+  keep = set()
+  for bucket in np.array_split(np.arange(len(y_values)), max_points // 2):
+    keep.add(bucket[np.argmin(y_values[bucket])])
+    keep.add(bucket[np.argmax(y_values[bucket])])
+  keep = sorted(keep)
+  return x_values[keep], y_values[keep]
+
+
+def _RenderTimeSeries(title, labels, t_list, value_matrix):
+  """Draws one line per label. Runs in a worker process."""
+  fig, ax, lines = _GetFigure()
+  import matplotlib.dates as mdates
+  start_t, end_t = t_list[0], t_list[-1]
+  x_values = np.array([
+      mdates.date2num(datetime.datetime.fromtimestamp(t)) for t in t_list])
+  while len(lines) > len(labels):
+    lines.pop().remove()
+  while len(lines) < len(labels):
+    lines.extend(ax.plot([], []))
+  for i, (line, label, y_values) in enumerate(
+      zip(lines, labels, value_matrix)):
+    line.set_data(*_Decimate(x_values, np.asarray(y_values),
+                             MAX_POINTS_PER_SERIES))
+    line.set_label(label)
+    # Recycled lines keep their old color, so pin the color to the position.
+    line.set_color('C%d' % (i % 10))
+  ax.relim()
+  ax.autoscale_view()
+  ax.set_title(title)
+  ax.set_xlabel('Date')
+  ax.set_ylabel('USD')
+  ax.legend(loc='best')
 
-if os.name != 'nt':
-  GRAPHLOC = '/tmp/fig.png'
-else:
-  GRAPHLOC = 'fig.png'
-
-def GraphPortfolioTimeSeries(title, users, start_t, end_t):
-  t_list = list(range(start_t, end_t, (end_t-start_t)//100)) + [end_t]
-  x_values = [
-      mdates.date2num(datetime.datetime.fromtimestamp(t)) for t in t_list]
-  # build the figure
-  fig, ax = plt.subplots()
-  dfs = []
-  for i, user in enumerate(users):
-    y_values = portfolio.GetPortfolio(user.id).GetValueList(t_list)
-    df = pd.DataFrame({'USD': y_values, 'Date': x_values})
-    df['unit'] = 'USD'
-    df['User'] = ('%s' % user)
-    dfs.append(df)
-  all_dfs = pd.concat(dfs)
-  graph = sns.tsplot(data=all_dfs, value='USD', time='Date', unit='unit', condition='User')
-  graph.set_title(title)
-
-  # assign locator and formatter for the xaxis ticks.
-  ax.xaxis.set_major_locator(mdates.AutoDateLocator())
   f = '%Y/%m/%d' if end_t - start_t > 86400 * 2 else '%m/%d %H:%M'
   ax.xaxis.set_major_formatter(mdates.DateFormatter(f))
 
   # put the labels at 45deg since they tend to be too long
   fig.autofmt_xdate()
-  plt.savefig(GRAPHLOC)
-  return GRAPHLOC
+  buf = io.BytesIO()
+  fig.savefig(buf, format='png')
+  return buf.getvalue()
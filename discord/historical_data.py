@@ -1,53 +1,235 @@
 #!/usr/bin/env python3
-"""Gather historical data from coinmarketcap via scraping."""
-import coin_data
-import coinmarketcap
-import requests
+"""Backfill coinhistory with daily prices scraped from coinmarketcap.
+
+Each coin's historical data page is fetched by a small pool of threads behind
+a shared rate limit, parsed as it streams in, and written to coinhistory (and
+the rollups) in batched upserts. Finished symbols are recorded in a checkpoint
+file, so an interrupted backfill picks up where it left off.
+
+Saved pages (SYMBOL.html) or coinmarketcap csv exports (SYMBOL.csv) can be
+used instead of the live site with --fixtures, which makes the whole pipeline
+runnable offline.
+
+Example usage:
+  ./historical_data.py --start 20130428 --end 20180108
+  ./historical_data.py --fixtures saved_pages/ --checkpoint /tmp/backfill.json
+"""
+import argparse
+import calendar
+import concurrent.futures
+import csv
+import datetime
+import json
+import os
 import re
+import threading
 import time
-import datetime
+import traceback
+import ingest
 
+# Captures the date and opening price of each row of the historical data table.
 REGEXP = '<td class="text-left">([^<]*)</td>[^<]*<td>([^<]*)</td>'
+URL = ('https://coinmarketcap.com/currencies/%s/historical-data/'
+       '?start=%s&end=%s')
+# Rows are written in batches of this many.
+BATCH_SIZE = 1000
+
+
+class RateLimiter(object):
+  """Spaces out calls to Wait() across threads to at most rate per second."""
+
+  def __init__(self, rate):
+    self._interval = 1.0 / rate
+    self._lock = threading.Lock()
+    self._next = time.time()
+
+  def Wait(self):
+    with self._lock:
+      now = time.time()
+      wait = self._next - now
+      self._next = max(now, self._next) + self._interval
+    if wait > 0:
+      time.sleep(wait)
+
+
+class Checkpoint(object):
+  """Per-symbol progress, persisted to a json file after every update."""
+
+  def __init__(self, path):
+    self._path = path
+    self._lock = threading.Lock()
+    self._done = {}
+    if path and os.path.exists(path):
+      with open(path) as fp:
+        self._done = json.load(fp)
+
+  def IsDone(self, symbol):
+    return symbol in self._done
+
+  def MarkDone(self, symbol, rows):
+    with self._lock:
+      self._done[symbol] = {'rows': rows, 'finished': int(time.time())}
+      if not self._path:
+        return
+      # Write then rename, so a crash never leaves a truncated checkpoint.
+      tmp_path = self._path + '.tmp'
+      with open(tmp_path, 'w') as fp:
+        json.dump(self._done, fp, indent=2, sort_keys=True)
+      os.replace(tmp_path, self._path)
+
+
+class CoinMarketCapSource(object):
+  """Fetches historical data pages from coinmarketcap."""
+
+  def __init__(self, start, end):
+    self._start = start
+    self._end = end
+
+  def Symbols(self):
+    """Returns a dict of symbol to coinmarketcap coin id."""
+    import coinmarketcap
+    coins = coinmarketcap.Market().ticker(limit=0)
+    return {c['symbol'].upper(): c['id'] for c in coins}
+
+  def Rows(self, symbol, coin_id):
+    import requests
+    page = requests.get(URL % (coin_id, self._start, self._end))
+    page.raise_for_status()
+    return ParseHtml(symbol, page.text)
+
+
+class FixtureSource(object):
+  """Reads saved SYMBOL.html pages or SYMBOL.csv exports from a directory."""
+
+  def __init__(self, directory):
+    self._directory = directory
 
-CoinData = coin_data._CoinDataSet(init_from_file=False)
-
-market = coinmarketcap.Market()
-coins = market.ticker(limit=0)
-print('number of coins: %s' % len(coins))
-symbol_to_id = {c['symbol']:c['id'] for c in coins}
-#symbol_to_id = {'XRB': 'raiblocks', 'BTC': 'bitcoin'}
-symbol_to_tuplelist = {}
-counter = 0
-for symbol in symbol_to_id:
-  counter += 1
-  print('on symbol %s, %s/%s' % (symbol, counter, len(symbol_to_id)))
-  page=requests.get('https://coinmarketcap.com/currencies/%s/historical-data/?start=20130428&end=20180108' % symbol_to_id[symbol])
-  #page=requests.get('https://coinmarketcap.com/currencies/%s/historical-data/?start=20180101&end=20180108' % symbol_to_id[symbol])
-  openings=re.findall(REGEXP, page.text, flags=re.DOTALL)
-  converted_openings = []
-  for tup in openings:
-    converted_openings.append((
-        int(time.mktime(datetime.datetime.strptime(tup[0], "%b %d, %Y").timetuple())),
-        tup[1]
-    ))
-  symbol_to_tuplelist[symbol] = converted_openings
-  time.sleep(6)
-
-for symbol in symbol_to_tuplelist:
-  for t in symbol_to_tuplelist[symbol]:
-    cdp = None
-    timestamp = t[0]
-    value = t[1]
+  def Symbols(self):
+    symbols = {}
+    for filename in sorted(os.listdir(self._directory)):
+      symbol, extension = os.path.splitext(filename)
+      if extension in ('.html', '.csv'):
+        symbols[symbol.upper()] = os.path.join(self._directory, filename)
+    return symbols
+
+  def Rows(self, symbol, path):
+    with open(path) as fp:
+      if path.endswith('.csv'):
+        # Materialized because the file is closed on return.
+        return list(ParseCsv(symbol, fp))
+      return ParseHtml(symbol, fp.read())
+
+
+def _ParseDate(date_str):
+  """Midnight UTC of a 'Jan 08, 2018' or '2018-01-08' date, as a timestamp."""
+  date_str = date_str.strip()
+  for fmt in ('%b %d, %Y', '%Y-%m-%d'):
     try:
-      cdp = CoinData._data[CoinData._data.bisect_left(coin_data._CoinDataPoint(timestamp))]
-    except IndexError:
+      parsed = datetime.datetime.strptime(date_str, fmt)
+      return calendar.timegm(parsed.timetuple())
+    except ValueError:
       pass
-    if not cdp or cdp.timestamp != timestamp:
-      new_cdp = coin_data._CoinDataPoint(timestamp, coin_data={symbol:value})
-      CoinData._data.add(new_cdp)
-    elif cdp.timestamp == timestamp:
-      cdp.coin_data[symbol] = value
-    else:
-      raise Error("Programming error")
-
-CoinData._DumpAllToFile('historical_data.coin_json')
+  raise ValueError('Unrecognized date %r' % date_str)
+
+
+def _ParsePrice(price_str):
+  return float(price_str.strip().replace(',', '').replace('$', ''))
+
+
+def ParseHtml(symbol, text):
+  """Yields (symbol, price, timestamp) rows from a historical data page."""
+  for match in re.finditer(REGEXP, text, flags=re.DOTALL):
+    date_str, price_str = match.groups()
+    try:
+      yield (symbol, _ParsePrice(price_str), _ParseDate(date_str))
+    except ValueError:
+      continue
+
+
+def ParseCsv(symbol, lines):
+  """Yields (symbol, price, timestamp) rows from a csv with Date/Open columns."""
+  for record in csv.DictReader(lines):
+    try:
+      yield (symbol, _ParsePrice(record['Open']), _ParseDate(record['Date']))
+    except (KeyError, ValueError):
+      continue
+
+
+def BackfillSymbol(source, symbol, key, limiter):
+  """Fetches one symbol and streams its rows into the database in batches."""
+  limiter.Wait()
+  count = 0
+  batch = []
+  for row in source.Rows(symbol, key):
+    batch.append(row)
+    if len(batch) >= BATCH_SIZE:
+      count += ingest.UpsertRows(batch).rows
+      batch = []
+  count += ingest.UpsertRows(batch).rows
+  return count
+
+
+def Backfill(source, checkpoint, concurrency=4, rate=0.5):
+  """Backfills every symbol the source knows about that isn't checkpointed.
+
+  Args:
+    source: A CoinMarketCapSource or FixtureSource.
+    checkpoint: A Checkpoint.
+    concurrency: How many symbols to fetch and write at once.
+    rate: The most page fetches to start per second.
+
+  Returns:
+    The symbols that failed.
+  """
+  symbols = {symbol: key for symbol, key in source.Symbols().items()
+             if not checkpoint.IsDone(symbol)}
+  print('%s symbols to backfill' % len(symbols))
+  limiter = RateLimiter(rate)
+  failed = []
+  with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+    futures = {
+        executor.submit(BackfillSymbol, source, symbol, key, limiter): symbol
+        for symbol, key in symbols.items()}
+    for counter, future in enumerate(
+        concurrent.futures.as_completed(futures), 1):
+      symbol = futures[future]
+      try:
+        rows = future.result()
+      except Exception:
+        failed.append(symbol)
+        print('Failed %s:\n%s' % (symbol, traceback.format_exc()))
+        continue
+      checkpoint.MarkDone(symbol, rows)
+      print('on symbol %s, %s/%s (%s rows)' % (
+          symbol, counter, len(symbols), rows))
+  return failed
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--start', default='20130428',
+                      help='First date to fetch, as YYYYMMDD.')
+  parser.add_argument('--end', default=time.strftime('%Y%m%d'),
+                      help='Last date to fetch, as YYYYMMDD.')
+  parser.add_argument('--fixtures', metavar='DIR',
+                      help='Read SYMBOL.html / SYMBOL.csv files from DIR '
+                           'instead of the live site.')
+  parser.add_argument('--checkpoint', default='historical_data.checkpoint',
+                      help='Progress file, used to resume after a crash.')
+  parser.add_argument('--concurrency', type=int, default=4)
+  parser.add_argument('--rate', type=float, default=0.5,
+                      help='Maximum page fetches per second.')
+  args = parser.parse_args()
+
+  if args.fixtures:
+    source = FixtureSource(args.fixtures)
+  else:
+    source = CoinMarketCapSource(args.start, args.end)
+  failed = Backfill(source, Checkpoint(args.checkpoint),
+                    concurrency=args.concurrency, rate=args.rate)
+  if failed:
+    print('Failed symbols (rerun to retry): %s' % ' '.join(sorted(failed)))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+"""Standalone ingestion daemon that writes ticker data into coinhistory.
+
+This runs as its own process so that slow coinmarketcap requests and database
+writes never block the bot's event loop, and so that a bot restart does not
+leave a gap in the price data.
+
+Example usage:
+  ./ingest.py
+  ./ingest.py --fake-ticker ticker.json --interval 5 --ticks 3
+"""
+from collections import namedtuple
+import argparse
+import json
+import math
+import time
+import traceback
+import coin_data
+import metrics
+import sql
+
+TickWriteResult = namedtuple('TickWriteResult', ['rows', 'seconds'])
+
+
+class CoinMarketCapSource(object):
+  """Reads the live ticker from coinmarketcap."""
+
+  def __init__(self):
+    import coinmarketcap
+    self._market = coinmarketcap.Market()
+
+  def Ticker(self):
+    return self._market.ticker(limit=0)
+
+
+class FakeTickerSource(object):
+  """Reads a ticker from a local json file in coinmarketcap's format.
+
+  The file is re-read on every tick, so it can be edited while the daemon is
+  running to simulate price movement.
+  """
+
+  def __init__(self, path):
+    self._path = path
+
+  def Ticker(self):
+    with open(self._path) as fp:
+      return json.load(fp)
+
+
+class TickScheduler(object):
+  """Runs a function on a fixed cadence.
+
+  Deadlines are laid out on a grid anchored at the first tick, so time spent
+  inside the function (or a late wakeup) never accumulates into drift. Ticks
+  that are missed entirely are skipped rather than run back to back. After a
+  failure the function is retried with exponential backoff, but never past
+  the next deadline on the grid.
+  """
+
+  def __init__(self, interval=300, base_backoff=5, max_backoff=120,
+               clock=time.time, sleep=time.sleep):
+    self._interval = interval
+    self._base_backoff = base_backoff
+    self._max_backoff = max_backoff
+    self._clock = clock
+    self._sleep = sleep
+    self._anchor = None
+
+  def NextDeadline(self, now):
+    """The first grid point strictly after now."""
+    periods = math.floor((now - self._anchor) / self._interval) + 1
+    return self._anchor + periods*self._interval
+
+  def Run(self, fn, max_attempts=None):
+    """Calls fn on every tick, forever or until max_attempts calls were made."""
+    self._anchor = self._clock()
+    deadline = self._anchor
+    failures = 0
+    attempts = 0
+    while max_attempts is None or attempts < max_attempts:
+      delay = deadline - self._clock()
+      if delay > 0:
+        self._sleep(delay)
+      attempts += 1
+      try:
+        fn()
+        failures = 0
+        deadline = self.NextDeadline(self._clock())
+      except Exception:
+        failures += 1
+        metrics.Increment('ingest.failures')
+        print('Exception in ingestion tick:\n%s' % traceback.format_exc())
+        backoff = min(self._max_backoff,
+                      self._base_backoff * 2**(failures - 1))
+        now = self._clock()
+        deadline = min(now + backoff, self.NextDeadline(now))
+
+
+def BuildTick(ticker, timestamp=None):
+  """Converts a coinmarketcap ticker into coinhistory rows.
+
+  Every row in a tick shares one timestamp. When several coins share a symbol
+  the highest ranked one wins.
+
+  Returns:
+    A list of (symbol, price, timestamp) tuples.
+  """
+  timestamp = int(timestamp if timestamp else time.time())
+  rows = []
+  seen = set()
+  for coin in sorted(ticker, key=lambda d: int(d["rank"])):
+    symbol = coin["symbol"].upper()
+    if coin["price_usd"] and symbol not in seen:
+      seen.add(symbol)
+      rows.append(
+          (symbol, float(coin["price_usd"].replace(',','')), timestamp))
+  return rows
+
+
+def WriteTick(rows):
+  """Inserts a tick's rows in a single multi-row statement and transaction.
+
+  Rows that already exist are left untouched. The hourly and daily rollups,
+  and the ticks table the bot follows, are updated in the same transaction.
+
+  Returns:
+    A TickWriteResult with the number of rows written and the wall time the
+    write took.
+  """
+  start = time.time()
+  if not rows:
+    return TickWriteResult(0, 0.0)
+  with sql.GetCursor(transaction=True) as cursor:
+    cursor.executemany(
+        'INSERT IGNORE INTO coinhistory (symbol, price, timestamp) '
+        'VALUES (%s, %s, %s)', rows)
+    written = cursor.rowcount
+    _UpsertRollups(cursor, rows)
+    cursor.executemany(
+        'INSERT IGNORE INTO ticks (timestamp) VALUES (%s)',
+        [(timestamp,) for timestamp in sorted(set(row[2] for row in rows))])
+  return TickWriteResult(written, time.time() - start)
+
+
+def UpsertRows(rows):
+  """Writes (symbol, price, timestamp) rows, replacing any existing prices.
+
+  Used for backfills, where the rows may overlap data written earlier. The
+  rollups are updated in the same transaction.
+
+  Returns:
+    A TickWriteResult.
+  """
+  start = time.time()
+  if not rows:
+    return TickWriteResult(0, 0.0)
+  with sql.GetCursor(transaction=True) as cursor:
+    cursor.executemany(
+        'INSERT INTO coinhistory (symbol, price, timestamp) '
+        'VALUES (%s, %s, %s) ON DUPLICATE KEY UPDATE price = VALUES(price)',
+        rows)
+    written = cursor.rowcount
+    _UpsertRollups(cursor, rows)
+  return TickWriteResult(written, time.time() - start)
+
+
+# Merges a bucket's OHLC row with an existing one. open/close only move if the
+# new row's ticks are earlier/later than the ones already stored, so rows can
+# be written in any order (e.g. by a backfill) and written more than once.
+_ROLLUP_UPSERT = (
+    'INSERT INTO %s (symbol, bucket, open, open_timestamp, high, low, close, '
+    'close_timestamp) VALUES (%%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s) '
+    'ON DUPLICATE KEY UPDATE '
+    'open = IF(VALUES(open_timestamp) < open_timestamp, VALUES(open), open), '
+    'open_timestamp = LEAST(open_timestamp, VALUES(open_timestamp)), '
+    'high = GREATEST(high, VALUES(high)), '
+    'low = LEAST(low, VALUES(low)), '
+    'close = IF(VALUES(close_timestamp) >= close_timestamp, VALUES(close), '
+    'close), '
+    'close_timestamp = GREATEST(close_timestamp, VALUES(close_timestamp))')
+
+
+def _UpsertRollups(cursor, rows):
+  """Folds (symbol, price, timestamp) rows into every rollup table."""
+  for resolution in coin_data.RESOLUTIONS[1:]:
+    cursor.executemany(
+        _ROLLUP_UPSERT % coin_data.ROLLUP_TABLES[resolution],
+        BuildRollupRows(rows, coin_data.ROLLUP_WIDTHS[resolution]))
+
+
+def BuildRollupRows(rows, width):
+  """Aggregates (symbol, price, timestamp) rows into OHLC buckets.
+
+  Returns:
+    A list of (symbol, bucket, open, open_timestamp, high, low, close,
+    close_timestamp) tuples, one per symbol and bucket.
+  """
+  buckets = {}
+  for symbol, price, timestamp in sorted(rows, key=lambda r: (r[0], r[2])):
+    key = (symbol, timestamp - timestamp % width)
+    if key not in buckets:
+      buckets[key] = [price, timestamp, price, price, price, timestamp]
+    else:
+      bucket = buckets[key]
+      bucket[2] = max(bucket[2], price)
+      bucket[3] = min(bucket[3], price)
+      bucket[4] = price
+      bucket[5] = timestamp
+  return [key + tuple(value) for key, value in sorted(buckets.items())]
+
+
+def RebuildRollups():
+  """Recomputes every rollup table from coinhistory, one symbol at a time."""
+  with sql.GetCursor() as cursor:
+    cursor.execute('SELECT DISTINCT symbol FROM coinhistory')
+    symbols = [r[0] for r in cursor.fetchall()]
+  for symbol in symbols:
+    count = 0
+    with sql.GetCursor(streaming=True) as cursor:
+      cursor.execute(
+          'SELECT symbol, price, timestamp FROM coinhistory '
+          'WHERE symbol = %s ORDER BY timestamp', (symbol,))
+      # The rollup upsert merges buckets, so each chunk can be written on its
+      # own without holding the symbol's whole history in memory.
+      for rows in sql.IterChunks(cursor):
+        with sql.GetCursor(transaction=True) as write_cursor:
+          _UpsertRollups(write_cursor, rows)
+        count += len(rows)
+    print('Rebuilt rollups for %s from %s rows' % (symbol, count))
+
+
+def IngestOnce(source, store=None):
+  """Downloads one tick from source and writes it to the database.
+
+  Args:
+    source: A CoinMarketCapSource or FakeTickerSource.
+    store: If given, a price_store.PriceStore the tick is also appended to,
+      after it has been committed to the database.
+  """
+  with metrics.Timer('ingest.tick'):
+    with metrics.Timer('ingest.download'):
+      rows = BuildTick(source.Ticker())
+    result = WriteTick(rows)
+    print('Wrote %s coinhistory rows in %.3fs' % result)
+    if store is not None:
+      store.Append(rows)
+  metrics.Increment('ingest.rows', result.rows)
+  return result
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--interval', type=float, default=300,
+                      help='Seconds between ticks.')
+  parser.add_argument('--fake-ticker', metavar='PATH',
+                      help='Read the ticker from a local json file instead '
+                           'of coinmarketcap.')
+  parser.add_argument('--ticks', type=int, default=None,
+                      help='Stop after this many ticks (default: run forever).')
+  parser.add_argument('--price-store', metavar='DIR',
+                      help='Also append every tick to this price_store.py '
+                           'directory.')
+  parser.add_argument('--metrics-file', metavar='PATH',
+                      help='Write metrics.py json here after every tick.')
+  parser.add_argument('--rebuild-rollups', action='store_true',
+                      help='Recompute the hourly/daily rollups from '
+                           'coinhistory and exit.')
+  args = parser.parse_args()
+
+  if args.rebuild_rollups:
+    RebuildRollups()
+    return
+
+  if args.fake_ticker:
+    source = FakeTickerSource(args.fake_ticker)
+  else:
+    source = CoinMarketCapSource()
+  store = None
+  if args.price_store:
+    import price_store
+    store = price_store.PriceStore(args.price_store)
+
+  def Tick():
+    try:
+      IngestOnce(source, store)
+    finally:
+      if args.metrics_file:
+        metrics.Dump(args.metrics_file)
+  TickScheduler(interval=args.interval).Run(Tick, max_attempts=args.ticks)
+
+
+if __name__ == '__main__':
+  main()
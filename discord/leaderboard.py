@@ -0,0 +1,203 @@
+"""Rankings of every portfolio by current value and 24h / 7d change.
+
+Each user's value and changes are kept in sorted lists, so the top k of a
+ranking is read off the front in O(k) and a user's position in O(log n).
+The numbers are recomputed for everyone, in one vectorized valuation, when
+a tick arrives, and for a single user when their portfolio changes. Current
+values use the latest raw prices, which are already in memory; the values
+24h and 7d ago use hourly closes, so a new tick doesn't query the database
+for fresh old prices more than once an hour. Once a day the value ranking
+is written to the daily_rankings table.
+
+Portfolios themselves are not kept here, only the ids of the ranked users;
+they are fetched through portfolio.py's bounded cache when needed.
+
+Example usage:
+  leaderboard.Load()  # Once the bot is ready, so it doesn't delay login.
+  coin_data.AddTickListener(leaderboard.OnTick)
+  portfolio.AddChangeListener(leaderboard.OnPortfolioChanged)
+  for user_id, entry in leaderboard.Top(leaderboard.VALUE, 10): ...
+"""
+from collections import namedtuple
+from sortedcontainers import SortedList
+import asyncio
+import time
+import traceback
+import coin_data
+import metrics
+import portfolio
+import scheduler
+import sql
+import valuation
+
+VALUE = 'value'
+CHANGE_24H = '24h'
+CHANGE_7D = '7d'
+METRICS = [VALUE, CHANGE_24H, CHANGE_7D]
+_CHANGE_SECONDS = {CHANGE_24H: 86400, CHANGE_7D: 7*86400}
+_FIELDS = {VALUE: 'value', CHANGE_24H: 'change_24h', CHANGE_7D: 'change_7d'}
+
+# value is in USD. The changes are percentages, or None for portfolios that
+# were worth nothing at the start of the period.
+Entry = namedtuple('Entry', ['value', 'change_24h', 'change_7d'])
+
+# Ids of the users with a portfolio, ranked or not yet.
+_user_ids = set()
+_entries = {}
+# Metric -> SortedList of (-metric, user id), so the best come first.
+_rankings = {metric: SortedList() for metric in METRICS}
+
+
+def _Key(entry, metric):
+  return getattr(entry, _FIELDS[metric])
+
+
+def Load():
+  """Rank every user with at least one transaction."""
+  loaded = portfolio.LoadPortfolios()
+  _user_ids.update(loaded)
+  _Refresh(list(_user_ids), portfolios=loaded)
+
+
+def _Refresh(user_ids, now=None, portfolios=None):
+  """Recompute the entries of user_ids, all valued at the same moment.
+
+  Args:
+    user_ids: The users to revalue.
+    now: The moment to value them at, by default the current time.
+    portfolios: A dict of user id to PortfolioHistory holding at least
+      user_ids' portfolios, if the caller already has them.
+  """
+  if portfolios is None:
+    portfolios = portfolio.LoadPortfolios(user_ids)
+  ranked = []
+  for user_id in user_ids:
+    if len(portfolios.get(user_id, ())):
+      ranked.append(user_id)
+    else:
+      _user_ids.discard(user_id)
+      _Remove(user_id)
+  user_ids = ranked
+  if not user_ids:
+    return
+  now = now or time.time()
+  portfolios = [portfolios[user_id] for user_id in user_ids]
+  values = {0: valuation.GetValueMatrix(portfolios, [now])[:, 0]}
+  width = coin_data.ROLLUP_WIDTHS[coin_data.HOURLY]
+  for seconds in _CHANGE_SECONDS.values():
+    # Rounded to the hour, so the old prices stay put between hourly ticks.
+    then = (now - seconds) // width * width
+    values[seconds] = valuation.GetValueMatrix(
+        portfolios, [then], coin_data.HOURLY)[:, 0]
+
+  def Change(row, seconds):
+    old = values[seconds][row]
+    if old <= 0:
+      return None
+    return float(100 * (values[0][row] - old) / old)
+
+  for row, user_id in enumerate(user_ids):
+    _Put(user_id, Entry(float(values[0][row]),
+                        Change(row, _CHANGE_SECONDS[CHANGE_24H]),
+                        Change(row, _CHANGE_SECONDS[CHANGE_7D])))
+
+
+def _Put(user_id, entry):
+  _Remove(user_id)
+  _entries[user_id] = entry
+  for metric in METRICS:
+    key = _Key(entry, metric)
+    if key is not None:
+      _rankings[metric].add((-key, user_id))
+
+
+def _Remove(user_id):
+  entry = _entries.pop(user_id, None)
+  if entry is None:
+    return
+  for metric in METRICS:
+    key = _Key(entry, metric)
+    if key is not None:
+      _rankings[metric].discard((-key, user_id))
+
+
+def OnTick(rows):
+  """coin_data tick listener: revalue everyone at the new tick."""
+  with metrics.Timer('leaderboard.refresh'):
+    _Refresh(list(_user_ids), rows[-1][2])
+
+
+def OnPortfolioChanged(p):
+  """portfolio change listener: revalue just that user."""
+  user_id = str(p.GetUserId())
+  _user_ids.add(user_id)
+  _Refresh([user_id], portfolios={user_id: p})
+
+
+def Get(user_id):
+  """The user's Entry, or None if they have no portfolio."""
+  return _entries.get(str(user_id))
+
+
+def Top(metric, k, user_ids=None):
+  """The best k (user id, Entry) pairs by metric.
+
+  Args:
+    metric: VALUE, CHANGE_24H or CHANGE_7D.
+    k: How many to return.
+    user_ids: If given, a set of user ids (e.g. a server's members) to
+      restrict the ranking to.
+  """
+  top = []
+  for _, user_id in _rankings[metric]:
+    if len(top) >= k:
+      break
+    if user_ids is None or user_id in user_ids:
+      top.append((user_id, _entries[user_id]))
+  return top
+
+
+def Rank(metric, user_id, user_ids=None):
+  """The user's 1-based position by metric, or None if they are unranked.
+
+  Restricted to user_ids, this counts the ranked users ahead of them that
+  are in the set.
+  """
+  user_id = str(user_id)
+  entry = _entries.get(user_id)
+  if entry is None or _Key(entry, metric) is None:
+    return None
+  index = _rankings[metric].index((-_Key(entry, metric), user_id))
+  if user_ids is None:
+    return index + 1
+  return 1 + sum(1 for _, other in _rankings[metric].islice(stop=index)
+                 if other in user_ids)
+
+
+def SnapshotDaily(day=None):
+  """Write everyone's value rank and entry to daily_rankings for day."""
+  day = int(day if day is not None else time.time() // 86400 * 86400)
+  rows = [(day, user_id, position + 1) + tuple(_entries[user_id])
+          for position, (_, user_id) in enumerate(_rankings[VALUE])]
+  if not rows:
+    return
+  with sql.GetCursor(transaction=True) as cursor:
+    cursor.executemany(
+        'INSERT INTO daily_rankings (day, user_id, position, value, '
+        'change_24h, change_7d) VALUES (%s, %s, %s, %s, %s, %s) '
+        'ON DUPLICATE KEY UPDATE position = VALUES(position), '
+        'value = VALUES(value), change_24h = VALUES(change_24h), '
+        'change_7d = VALUES(change_7d)',
+        rows)
+
+
+async def SnapshotForever():
+  """Call SnapshotDaily just after every midnight UTC."""
+  while True:
+    now = time.time()
+    await asyncio.sleep(scheduler.NextRun(86400, now) - now)
+    try:
+      # The rankings as of the end of the day that just finished.
+      SnapshotDaily(time.time() // 86400 * 86400 - 86400)
+    except Exception as e:
+      print('Exception in SnapshotForever:\n%s' % (traceback.format_exc()))
@@ -0,0 +1,127 @@
+"""Per-server indexes for finding members by approximate name.
+
+Scoring every member with util.GetUserFromNameStr costs three SequenceMatcher
+ratios each, which adds up on large servers. Instead each server keeps a
+trigram index over its members' names: a lookup collects the members that
+share the most trigrams with the query and scores only those. Recent
+lookups are memoized until the server's membership or names change.
+
+The index is built the first time a server is searched, and bot.py keeps it
+current from member join, leave and update events.
+
+Example usage:
+  user = member_index.GetMemberFromNameStr(ctx.message.server, 'satoshi')
+"""
+import collections
+import heapq
+import cache
+import util
+
+# How many of the members sharing the most trigrams get scored exactly.
+MAX_CANDIDATES = 50
+# How many name -> member resolutions each server remembers.
+MEMO_SIZE = 256
+
+_indexes = {}
+
+
+def _Trigrams(s):
+  # Padding gives even one or two character names a few trigrams, and
+  # weights the start of a name the way people tend to abbreviate.
+  s = '  %s ' % s.upper()
+  return {s[i:i+3] for i in range(len(s) - 2)}
+
+
+def _Names(member):
+  return [str(member), member.name, str(member.display_name)]
+
+
+class NameIndex(object):
+  """A trigram index over the names of one server's members."""
+
+  def __init__(self, members=()):
+    self._members = {}
+    # Insertion order, used to break ties the way a linear scan would.
+    self._order = {}
+    self._next_order = 0
+    self._trigrams = {}
+    self._postings = collections.defaultdict(set)
+    self._memo = cache.Cache(max_entries=MEMO_SIZE)
+    for member in members:
+      self.Add(member)
+
+  def __len__(self):
+    return len(self._members)
+
+  def Add(self, member):
+    self.Remove(member)
+    trigrams = set()
+    for name in _Names(member):
+      trigrams |= _Trigrams(name)
+    self._members[member.id] = member
+    self._order[member.id] = self._next_order
+    self._next_order += 1
+    self._trigrams[member.id] = trigrams
+    for trigram in trigrams:
+      self._postings[trigram].add(member.id)
+    self._memo.Clear()
+
+  def Remove(self, member):
+    if member.id not in self._members:
+      return
+    for trigram in self._trigrams.pop(member.id):
+      postings = self._postings[trigram]
+      postings.discard(member.id)
+      if not postings:
+        del self._postings[trigram]
+    del self._members[member.id]
+    del self._order[member.id]
+    self._memo.Clear()
+
+  def Find(self, name_str):
+    """The member whose name best matches name_str, or None."""
+    key = name_str.upper()
+    if key in self._memo:
+      member_id = self._memo.Get(key)
+      return self._members.get(member_id) if member_id else None
+    member = self._Search(name_str)
+    self._memo.Put(key, member.id if member else 0)
+    return member
+
+  def _Search(self, name_str):
+    overlaps = collections.Counter()
+    for trigram in _Trigrams(name_str):
+      overlaps.update(self._postings.get(trigram, ()))
+    candidates = heapq.nsmallest(
+        MAX_CANDIDATES, overlaps,
+        key=lambda member_id: (-overlaps[member_id], self._order[member_id]))
+    candidates.sort(key=self._order.get)
+    return util.GetUserFromNameStr(
+        (self._members[member_id] for member_id in candidates), name_str)
+
+
+def GetIndex(server):
+  index = _indexes.get(server.id)
+  if index is None:
+    index = _indexes[server.id] = NameIndex(server.members)
+  return index
+
+
+def GetMemberFromNameStr(server, name_str):
+  """Find the member of server whose name is closest to name_str."""
+  return GetIndex(server).Find(name_str)
+
+
+def AddMember(member):
+  """Index a member that joined a server or changed their names."""
+  if member.server.id in _indexes:
+    _indexes[member.server.id].Add(member)
+
+
+def RemoveMember(member):
+  if member.server.id in _indexes:
+    _indexes[member.server.id].Remove(member)
+
+
+def ForgetServer(server):
+  _indexes.pop(server.id, None)
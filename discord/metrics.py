@@ -0,0 +1,188 @@
+"""Lightweight in-process metrics: counters, latency histograms and gauges.
+
+Recording is a lock, a dict lookup and a bisect into fixed buckets, so it is
+cheap enough to leave on everywhere, including from executor threads.
+Gauges are functions (such as a cache's Stats method) that are only called
+when a report is built.
+
+Example usage:
+  with metrics.Timer('coin_data.follow'):
+    ...
+  metrics.Increment('ingest.rows', len(rows))
+  metrics.RegisterGauge('coin_cache', _coin_cache.Stats)
+  print(metrics.Format())
+"""
+import asyncio
+import bisect
+import json
+import os
+import threading
+import time
+import traceback
+
+# Histogram bucket upper bounds in seconds: 100us, doubling up to ~105s.
+BUCKET_BOUNDS = [0.0001 * 2**i for i in range(21)]
+# How often DumpPeriodically writes the metrics file.
+DUMP_INTERVAL = 60
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_gauges = {}
+_start_time = time.time()
+
+
+class Histogram(object):
+  """Counts observations in exponentially sized buckets."""
+
+  def __init__(self):
+    # The last bucket holds everything above BUCKET_BOUNDS[-1].
+    self.counts = [0] * (len(BUCKET_BOUNDS) + 1)
+    self.count = 0
+    self.total = 0.0
+    self.max = 0.0
+
+  def Observe(self, seconds):
+    self.counts[bisect.bisect_left(BUCKET_BOUNDS, seconds)] += 1
+    self.count += 1
+    self.total += seconds
+    if seconds > self.max:
+      self.max = seconds
+
+  def Percentile(self, p):
+    """An upper bound on the p'th percentile, accurate to within 2x."""
+    rank = p / 100.0 * self.count
+    seen = 0
+    for i, n in enumerate(self.counts):
+      seen += n
+      if n and seen >= rank:
+        if i < len(BUCKET_BOUNDS):
+          return min(BUCKET_BOUNDS[i], self.max)
+        return self.max
+    return 0.0
+
+  def Summary(self):
+    return {
+        'count': self.count,
+        'mean_ms': 1000 * self.total / self.count if self.count else 0.0,
+        'p50_ms': 1000 * self.Percentile(50),
+        'p90_ms': 1000 * self.Percentile(90),
+        'p99_ms': 1000 * self.Percentile(99),
+        'max_ms': 1000 * self.max,
+    }
+
+
+class Timer(object):
+  """A context manager that observes the time spent inside it under name."""
+
+  def __init__(self, name):
+    self._name = name
+    self._start = None
+
+  def __enter__(self):
+    self._start = time.perf_counter()
+    return self
+
+  def __exit__(self, exception, value, traceback):
+    Observe(self._name, time.perf_counter() - self._start)
+
+
+def Increment(name, n=1):
+  with _lock:
+    _counters[name] = _counters.get(name, 0) + n
+
+
+def Observe(name, seconds):
+  """Record one latency observation, in seconds, in the histogram name."""
+  with _lock:
+    histogram = _histograms.get(name)
+    if histogram is None:
+      histogram = _histograms[name] = Histogram()
+    histogram.Observe(seconds)
+
+
+def RegisterGauge(name, fn):
+  """Report fn() under name; fn should return a number or a dict of them."""
+  _gauges[name] = fn
+
+
+def Reset():
+  """Forget all counters and histograms. Gauges stay registered."""
+  global _start_time
+  with _lock:
+    _counters.clear()
+    _histograms.clear()
+    _start_time = time.time()
+
+
+def Snapshot():
+  """All metrics as a json serializable dict."""
+  with _lock:
+    report = {
+        'time': time.time(),
+        'uptime': time.time() - _start_time,
+        'counters': dict(_counters),
+        'histograms': {name: histogram.Summary()
+                       for name, histogram in _histograms.items()},
+    }
+  report['gauges'] = {}
+  for name, fn in list(_gauges.items()):
+    try:
+      report['gauges'][name] = fn()
+    except Exception as e:
+      report['gauges'][name] = 'error: %s' % e
+  return report
+
+
+def _FlattenGauge(name, value):
+  if isinstance(value, dict):
+    for key, inner in sorted(value.items()):
+      yield from _FlattenGauge('%s.%s' % (name, key), inner)
+  else:
+    yield name, value
+
+
+def Format(prefix=None):
+  """A printable report of every metric whose name starts with prefix."""
+  report = Snapshot()
+  lines = ['uptime %.0fs' % report['uptime']]
+  for name, summary in sorted(report['histograms'].items()):
+    if prefix and not name.startswith(prefix):
+      continue
+    lines.append(name)
+    lines.append('  n=%-7d p50 %8.1fms  p99 %8.1fms  max %8.1fms' % (
+        summary['count'], summary['p50_ms'], summary['p99_ms'],
+        summary['max_ms']))
+  for name, value in sorted(report['counters'].items()):
+    if not prefix or name.startswith(prefix):
+      lines.append('%-32s %d' % (name, value))
+  for name, value in sorted(report['gauges'].items()):
+    if prefix and not name.startswith(prefix):
+      continue
+    if isinstance(value, dict) and value.get('hits', 0) + value.get(
+        'misses', 0):
+      lines.append('%-32s %.1f%%' % (
+          name + '.hit_rate',
+          100.0 * value['hits'] / (value['hits'] + value['misses'])))
+    for flat_name, flat_value in _FlattenGauge(name, value):
+      lines.append('%-32s %s' % (flat_name, flat_value))
+  return '\n'.join(lines)
+
+
+def Dump(path):
+  """Write Snapshot() to path as json."""
+  # Write then rename, so readers never see a half written file.
+  temp_path = path + '.tmp'
+  with open(temp_path, 'w') as fp:
+    json.dump(Snapshot(), fp, indent=2, sort_keys=True)
+  os.replace(temp_path, path)
+
+
+async def DumpPeriodically(path, interval=DUMP_INTERVAL):
+  """Dump the metrics to path every interval seconds, forever."""
+  while True:
+    await asyncio.sleep(interval)
+    try:
+      Dump(path)
+    except Exception as e:
+      print('Exception in DumpPeriodically:\n%s' % (traceback.format_exc()))
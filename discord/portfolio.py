@@ -10,18 +10,97 @@ import json
 import os
 import time
 import copy
+import itertools
+import cache
 import coin_data
+import metrics
+import numpy as np
+import valuation
 
 import util
 import time
 import sql
 
-_portfolios = {}
+# Users known to have no transactions are cached as (negative) empty
+# portfolios, so that looking them up again doesn't query the database.
+_portfolios = cache.Cache(max_entries=5000, is_negative=lambda p: not len(p))
+metrics.RegisterGauge('portfolio_cache', _portfolios.Stats)
+# Every load of or change to a portfolio gets a new revision, so a revision
+# identifies a portfolio's contents even across cache evictions.
+_revisions = itertools.count()
+# Functions called with a PortfolioHistory after each change made to it.
+_change_listeners = []
+# The most user ids LoadPortfolios puts in one query's IN list.
+BULK_LOAD_CHUNK = 1000
+
+_TRANSACTION_COLUMNS = (
+    'type, timestamp, in_symbol, in_amount, out_symbol, out_amount')
 
 def GetPortfolio(user_id):
-  if user_id not in _portfolios:
-    _portfolios[user_id] = PortfolioHistory(user_id)
-  return _portfolios[user_id]
+  return _portfolios.Get(user_id, PortfolioHistory)
+
+
+def LoadPortfolios(user_ids=None):
+  """Load many portfolios with one streamed query, rather than one each.
+
+  Args:
+    user_ids: The users to load, e.g. a server's members. By default,
+      every user with any transactions.
+
+  Returns:
+    A dict of user id to PortfolioHistory, for the users that have
+    transactions. The others are cached as empty, so later lookups of them
+    (including through GetPortfolio) don't touch the database for a while.
+  """
+  loaded = {}
+  if user_ids is None:
+    missing = None
+  else:
+    missing = []
+    for user_id in user_ids:
+      p = _portfolios.Peek(user_id)
+      if p is not None:
+        loaded[user_id] = p
+      else:
+        missing.append(user_id)
+  if missing is None:
+    _LoadTransactions(None, loaded)
+  for start in range(0, len(missing or ()), BULK_LOAD_CHUNK):
+    chunk = missing[start:start + BULK_LOAD_CHUNK]
+    _LoadTransactions(chunk, loaded)
+    for user_id in chunk:
+      if user_id not in loaded:
+        _portfolios.Put(user_id, PortfolioHistory(user_id, transactions=[]))
+  return {user_id: p for user_id, p in loaded.items() if len(p)}
+
+
+def _LoadTransactions(user_ids, loaded):
+  """Build and cache the portfolios of user_ids (or everyone) into loaded.
+
+  Portfolios that are already cached are kept as they are.
+  """
+  # Ids come back from the database as numbers; key them the way callers do.
+  requested = {str(user_id): user_id for user_id in user_ids or ()}
+  query = 'SELECT user_id, %s FROM transactions' % _TRANSACTION_COLUMNS
+  args = ()
+  if user_ids is not None:
+    query += ' WHERE user_id IN (%s)' % ', '.join(['%s'] * len(user_ids))
+    args = user_ids
+  with sql.GetCursor(streaming=True) as cursor:
+    cursor.execute(query + ' ORDER BY user_id', args)
+    for db_user_id, rows in itertools.groupby(sql.IterRows(cursor),
+                                              key=lambda row: row[0]):
+      user_id = requested.get(str(db_user_id), str(db_user_id))
+      p = _portfolios.Peek(user_id)
+      if p is None:
+        p = PortfolioHistory(user_id, [row[1:] for row in rows])
+        _portfolios.Put(user_id, p)
+      loaded[user_id] = p
+
+
+def AddChangeListener(fn):
+  """Call fn(portfolio) after every transaction added to or cleared from it."""
+  _change_listeners.append(fn)
 
 class Transaction(object):
   
@@ -47,57 +126,149 @@ class Transaction(object):
   def __le__(self, oth):
     return (self < oth) or not (oth < self)
 
+def _BuildTransactions(rows):
+  """A SortedList of Transactions from transactions table rows."""
+  return SortedList(
+      Transaction(type=t[0], timestamp=t[1], in_symbol=t[2], in_amount=t[3],
+                  out_symbol=t[4], out_amount=t[5])
+      for t in rows)
+
 class PortfolioHistory(SortedDict):
   """Represents the historical holdings of a portfolio.
 
   Usually this class should only be instantiated by GetPortfolio.
   """
 
-  def __init__(self, user_id):
+  def __init__(self, user_id, transactions=None):
+    """Load a user's portfolio.
+
+    Args:
+      user_id: The discord id of the user.
+      transactions: The user's rows of the transactions table, as
+        (type, timestamp, in_symbol, in_amount, out_symbol, out_amount)
+        tuples, if they were already fetched (see LoadPortfolios).
+        Otherwise they are queried here.
+    """
     super(PortfolioHistory, self).__init__()
     self._user_id = user_id
-    with sql.GetCursor() as cursor:
-      cursor.execute(
-          'SELECT type, timestamp, in_symbol, in_amount, out_symbol, out_amount '
-          'FROM transactions where user_id = %s' % user_id)
-      self._transactions = SortedList([
-          Transaction(type=t[0], timestamp=t[1], in_symbol=t[2], in_amount=t[3],
-                      out_symbol=t[4], out_amount=t[5]) for t in cursor.fetchall()])
+    self._Changed()
+    if transactions is None:
+      with sql.GetCursor(streaming=True) as cursor:
+        cursor.execute(
+            'SELECT %s FROM transactions where user_id = %s' % (
+                _TRANSACTION_COLUMNS, user_id))
+        # Built straight from the stream, so the raw rows are never all
+        # held at once next to the Transactions.
+        self._transactions = _BuildTransactions(sql.IterRows(cursor))
+    else:
+      self._transactions = _BuildTransactions(transactions)
     self.InitFromTransactions()
 
   def InitFromTransactions(self):
-    # TODO(brandonsalmon): If it becomes necessary, we can greatly improve
-    # the performance of !buy, !sell, !trade, by adding a transaction cursor
-    # and not reinitializing all transactions every time.
+    """Rebuild every snapshot by replaying the whole transaction log."""
+    self._Changed()
     self.clear()
     for t in self._transactions:
-      if t.type == "INIT":
-        self[t.timestamp] = {}
-        continue
-      if t.timestamp not in self:
-        bisect_point = self.bisect(t.timestamp)
-        if(bisect_point) is 0:
-          copy = {}
-        else:
-          copy = self[self._list[bisect_point-1]].copy()
-        self[t.timestamp] = copy
-      if t.in_symbol:
-        if t.in_symbol not in self[t.timestamp]:
-          self[t.timestamp][t.in_symbol] = 0
-        self[t.timestamp][t.in_symbol] += t.in_amount
-      if t.out_symbol:
-        if t.out_symbol not in self[t.timestamp]:
-          raise Exception('%s tried to remove coin %s they didn\'t own' % (
-                              self._user_id, t.out_symbol))
-        self[t.timestamp][t.out_symbol] -= t.out_amount
-        if self[t.timestamp][t.out_symbol] < 1e-10:
-          del self[t.timestamp][t.out_symbol]
+      self._ApplyTransaction(t)
+
+  def _Changed(self):
+    self._snapshot_matrix = None
+    self._revision = next(_revisions)
+
+  def GetRevision(self):
+    return self._revision
+
+  def GetUserId(self):
+    return self._user_id
+
+  def _NotifyChanged(self):
+    # Whether the cache holds this portfolio as empty depends on its
+    # contents, so have it look again.
+    if _portfolios.Peek(self._user_id) is self:
+      _portfolios.Put(self._user_id, self)
+    for fn in _change_listeners:
+      fn(self)
+
+  def _AddTransaction(self, transaction):
+    """Insert a transaction and update only the snapshots it affects.
+
+    A transaction that sorts after every existing one only touches the
+    snapshot at its own timestamp. A back-dated transaction invalidates the
+    snapshots from its timestamp onwards, which are replayed from there.
+    """
+    self._Changed()
+    index = self._transactions.bisect(transaction)
+    self._transactions.insert(index, transaction)
+    if index == len(self._transactions) - 1:
+      self._ApplyTransaction(transaction)
+    else:
+      self._ReplayFrom(transaction.timestamp)
+    self._NotifyChanged()
+
+  def _ReplayFrom(self, timestamp):
+    for key in list(self.irange(minimum=timestamp)):
+      del self[key]
+    # INIT sorts first on a timestamp, so this finds the first transaction at
+    # or after timestamp.
+    start = self._transactions.bisect_left(
+        Transaction(type='INIT', timestamp=timestamp))
+    for t in self._transactions.islice(start):
+      self._ApplyTransaction(t)
+
+  def _ApplyTransaction(self, t):
+    """Apply a transaction on top of the snapshots of everything before it."""
+    if t.type == "INIT":
+      self[t.timestamp] = {}
+      return
+    if t.timestamp not in self:
+      bisect_point = self.bisect(t.timestamp)
+      if(bisect_point) is 0:
+        copy = {}
+      else:
+        copy = self[self._list[bisect_point-1]].copy()
+      self[t.timestamp] = copy
+    if t.in_symbol:
+      if t.in_symbol not in self[t.timestamp]:
+        self[t.timestamp][t.in_symbol] = 0
+      self[t.timestamp][t.in_symbol] += t.in_amount
+    if t.out_symbol:
+      if t.out_symbol not in self[t.timestamp]:
+        raise Exception('%s tried to remove coin %s they didn\'t own' % (
+                            self._user_id, t.out_symbol))
+      self[t.timestamp][t.out_symbol] -= t.out_amount
+      if self[t.timestamp][t.out_symbol] < 1e-10:
+        del self[t.timestamp][t.out_symbol]
 
   def CreationDate(self):
     return self._transactions[0].timestamp
 
   def GetValueList(self, t_list):
-    return [self.Value(t) for t in t_list]
+    return valuation.GetValueMatrix([self], t_list)[0].tolist()
+
+  def GetHoldingsMatrix(self, t_list):
+    """The amount of each owned coin at each timestamp.
+
+    Returns:
+      A tuple of (symbols, holdings), where holdings is a
+      len(t_list) x len(symbols) numpy array.
+    """
+    if not len(self):
+      # Nothing to index into; the portfolio owned nothing at any time.
+      return [], np.zeros((len(t_list), 0))
+    if self._snapshot_matrix is None:
+      symbols = sorted(set(s for data in self.values() for s in data))
+      columns = {symbol: i for i, symbol in enumerate(symbols)}
+      amounts = np.zeros((len(self), len(symbols)))
+      for row, data in enumerate(self.values()):
+        for symbol, amount in data.items():
+          amounts[row, columns[symbol]] = amount
+      keys = np.fromiter(self.keys(), dtype=np.float64, count=len(self))
+      self._snapshot_matrix = (symbols, keys, amounts)
+    symbols, keys, amounts = self._snapshot_matrix
+    rows = np.searchsorted(keys, np.asarray(t_list), side='right') - 1
+    holdings = amounts[np.maximum(rows, 0)]
+    holdings[rows < 0] = 0.0
+    return symbols, holdings
 
   def GetChange(self, timestamp=None, timedelta='24h'):
     dt = datetime.fromtimestamp(timestamp) if timestamp else datetime.now()
@@ -117,7 +288,10 @@ class PortfolioHistory(SortedDict):
     with sql.GetCursor() as cursor:
       cursor.execute(
           'DELETE FROM transactions where user_id = %s' % self._user_id)
+    self._transactions.clear()
+    self._Changed()
     self.clear()
+    self._NotifyChanged()
 
   def Init(self, tuples, timestamp=None):
     """Takes a list of tuples of (symbol, amount)."""
@@ -127,27 +301,19 @@ class PortfolioHistory(SortedDict):
           'INSERT INTO transactions (user_id, type, timestamp) '
           'values (%s, "%s", %s)' % (self._user_id, "INIT", timestamp))
 
-    transaction = Transaction(type="INIT", timestamp=timestamp)
-    self._transactions.insert(self._transactions.bisect(transaction),
-                              transaction)
+    self._AddTransaction(Transaction(type="INIT", timestamp=timestamp))
     for t in tuples:
-      self.Buy(t[0], t[1], timestamp, init=False)
-    self.InitFromTransactions()
-    
+      self.Buy(t[0], t[1], timestamp)
   
-  def Buy(self, symbol, amount, timestamp=None, init=True):
+  def Buy(self, symbol, amount, timestamp=None):
     timestamp = int(timestamp if timestamp else time.time())
     with sql.GetCursor() as cursor:
       cursor.execute(
           'INSERT INTO transactions (user_id, type, timestamp, in_symbol, in_amount) '
           'values (%s, "%s", %s, "%s", %s)' % (
               self._user_id, "BUY", timestamp, symbol.upper(), amount))
-    transaction = Transaction(type="BUY", timestamp=timestamp, in_symbol=symbol.upper(),
-                              in_amount=amount)
-    self._transactions.insert(self._transactions.bisect(transaction),
-                              transaction)
-    if init:
-      self.InitFromTransactions()
+    self._AddTransaction(Transaction(type="BUY", timestamp=timestamp,
+                                     in_symbol=symbol.upper(), in_amount=amount))
 
   def Sell(self, symbol, amount, timestamp=None):
     timestamp = int(timestamp if timestamp else time.time())
@@ -156,11 +322,8 @@ class PortfolioHistory(SortedDict):
           'INSERT INTO transactions (user_id, type, timestamp, out_symbol, out_amount) '
           'values (%s, "%s", %s, "%s", %s)' % (
               self._user_id, "SELL", timestamp, symbol.upper(), amount))
-    transaction = Transaction(type="SELL", timestamp=timestamp, out_symbol=symbol.upper(),
-                              out_amount=amount)
-    self._transactions.insert(self._transactions.bisect(transaction),
-                              transaction)
-    self.InitFromTransactions()
+    self._AddTransaction(Transaction(type="SELL", timestamp=timestamp,
+                                     out_symbol=symbol.upper(), out_amount=amount))
 
   def Trade(self, in_symbol, in_amount, out_symbol, out_amount, timestamp=None):
     timestamp = int(timestamp if timestamp else time.time())
@@ -170,12 +333,9 @@ class PortfolioHistory(SortedDict):
           'out_symbol, out_amount) values (%s, "%s", %s, "%s", %s, "%s", %s)' % (
               self._user_id, "SELL", timestamp, in_symbol.upper(), in_amount,
               out_symbol.upper(), out_amount))
-    transaction = Transaction(type="TRADE", timestamp=timestamp,
-                              out_symbol=out_symbol.upper(), out_amount=out_amount, 
-                              in_symbol=in_symbol.upper(), in_amount=in_amount)
-    self._transactions.insert(self._transactions.bisect(transaction),
-                              transaction)
-    self.InitFromTransactions()
+    self._AddTransaction(Transaction(type="TRADE", timestamp=timestamp,
+                                     out_symbol=out_symbol.upper(), out_amount=out_amount,
+                                     in_symbol=in_symbol.upper(), in_amount=in_amount))
 
   def Value(self, timestamp=None):
     try:
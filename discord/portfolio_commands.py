@@ -1,11 +1,38 @@
 from discord.ext import commands
 import util
 import datetime
+import io
 import time
 import meme_helper
 import graph
+import leaderboard
+import member_index
 import portfolio
 
+
+def FormatList(user, timestamp=None):
+  """The text of !list for user's portfolio at timestamp (default: now)."""
+  p = portfolio.GetPortfolio(user.id)
+  return ('```%s\'s portfolio:\n'
+          'Total Value: $%s (%s) \n'
+          '%s```' % (user, p.Value(timestamp), p.GetChange(timestamp),
+                     p.AsTable(timestamp)))
+
+
+async def GraphUsers(users, time_delta="", now=None):
+  """The PNG of !graph for users over time_delta before now.
+
+  Without a time_delta the graph starts at the oldest of the portfolios.
+  """
+  end = datetime.datetime.fromtimestamp(now) if now else datetime.datetime.now()
+  if time_delta == "":
+    start_t = min(portfolio.GetPortfolio(user.id).CreationDate() for user in users)
+  else:
+    start_t = int((end - util.GetTimeDelta(time_delta)).timestamp())
+  end_t = int(end.timestamp())
+  return await graph.GraphPortfolioTimeSeries('Gainz', users, start_t, end_t)
+
+
 class Portfolio(object):
   """Commands related to interacting with portfolios."""
 
@@ -58,7 +85,7 @@ class Portfolio(object):
     if not user:
       user = ctx.message.author
     else:
-      user = util.GetUserFromNameStr(ctx.message.server.members, user)
+      user = member_index.GetMemberFromNameStr(ctx.message.server, user)
     p = portfolio.GetPortfolio(user.id)
     await self.bot.say('%s\'s portfolio is now worth $%.2f.' % 
                        (user, p.Value()))
@@ -119,18 +146,19 @@ class Portfolio(object):
   async def graph(self, ctx, time_delta="", *users : str):
     """Graph portfolios."""
     if not users:
-      users = [user for user in ctx.message.server.members
-               if len(portfolio.GetPortfolio(user.id))]
+      members = list(ctx.message.server.members)
+      portfolios = portfolio.LoadPortfolios([user.id for user in members])
+      users = [user for user in members if user.id in portfolios]
     else:
-      users = [util.GetUserFromNameStr(ctx.message.server.members, user)
+      users = [member_index.GetMemberFromNameStr(ctx.message.server, user)
                for user in users]
-    if time_delta is "":
-      start_t = min(portfolio.GetPortfolio(user.id).CreationDate() for user in users)
-    else:
-      start_t = int((datetime.datetime.now() - util.GetTimeDelta(time_delta)).timestamp())
-    end_t = int(datetime.datetime.now().timestamp())
-    graph_file = graph.GraphPortfolioTimeSeries('Gainz', users, start_t, end_t)
-    await self.bot.upload(graph_file)
+    try:
+      png = await GraphUsers(users, time_delta)
+    except graph.RenderQueueFull:
+      await self.bot.say('Too many graphs are being drawn right now, try '
+                         'again in a bit.')
+      return
+    await self.bot.upload(io.BytesIO(png), filename='graph.png')
 
   @commands.command(aliases=['display', 'ls'], pass_context=True)
   async def list(self, ctx, user=None, date=None):
@@ -138,14 +166,8 @@ class Portfolio(object):
     if not user:
       user = ctx.message.author
     else:
-      user = util.GetUserFromNameStr(ctx.message.server.members, user)
-    timestamp = util.GetTimestamp(date)
-    p = portfolio.GetPortfolio(user.id)
-    await self.bot.say(
-        '```%s\'s portfolio:\n'
-        'Total Value: $%s (%s) \n'
-        '%s```' % (user, p.Value(timestamp), p.GetChange(timestamp),
-                   p.AsTable(timestamp)))
+      user = member_index.GetMemberFromNameStr(ctx.message.server, user)
+    await self.bot.say(FormatList(user, util.GetTimestamp(date)))
 
   @commands.command(aliases=['bd'], pass_context=True)
   async def breakdown(self, ctx, user=None, date=None):
@@ -153,7 +175,7 @@ class Portfolio(object):
     if not user:
       user = ctx.message.author
     else:
-      user = util.GetUserFromNameStr(ctx.message.server.members, user)
+      user = member_index.GetMemberFromNameStr(ctx.message.server, user)
     timestamp = util.GetTimestamp(date)
     p = portfolio.GetPortfolio(user.id)
     change = p.GetChange(timestamp)
@@ -162,3 +184,47 @@ class Portfolio(object):
         'Total Value: $%s (%s) \n'
         '%s```' % (user, p.Value(timestamp), p.GetChange(timestamp),
                    p.BreakTable(timestamp)))
+
+  @commands.command(aliases=['lb', 'rankings'], pass_context=True)
+  async def leaderboard(self, ctx, metric=leaderboard.VALUE, count : int = 10):
+    """Show the server's top portfolios by value, 24h or 7d change.
+
+    example: !leaderboard 24h 5
+    """
+    if metric not in leaderboard.METRICS:
+      await self.bot.say('Rank by one of %s.' % ', '.join(leaderboard.METRICS))
+      return
+    server = ctx.message.server
+    members = {member.id: member for member in server.members}
+    top = leaderboard.Top(metric, min(count, 25), set(members))
+    if not top:
+      await self.bot.say('Nobody on this server has a portfolio yet.')
+      return
+    await self.bot.say('```Top portfolios by %s:\n%s```' % (metric, '\n'.join(
+        '%2d. %-24s %s' % (i + 1, members[user_id], _FormatEntry(entry))
+        for i, (user_id, entry) in enumerate(top))))
+
+  @commands.command(pass_context=True)
+  async def rank(self, ctx, user=None):
+    """Show where you, or another user, rank on the server."""
+    if not user:
+      user = ctx.message.author
+    else:
+      user = member_index.GetMemberFromNameStr(ctx.message.server, user)
+    entry = leaderboard.Get(user.id)
+    if entry is None:
+      await self.bot.say('%s doesn\'t have a portfolio.' % user)
+      return
+    members = set(member.id for member in ctx.message.server.members)
+    ranks = [(leaderboard.Rank(metric, user.id, members), metric)
+             for metric in leaderboard.METRICS]
+    ranks = ', '.join('#%s by %s' % (position, metric)
+                      for position, metric in ranks if position is not None)
+    await self.bot.say('%s is %s (%s).' % (user, ranks, _FormatEntry(entry)))
+
+
+def _FormatEntry(entry):
+  def Percent(change):
+    return 'n/a' if change is None else '%+.2f%%' % change
+  return '$%.2f, %s 24h, %s 7d' % (
+      entry.value, Percent(entry.change_24h), Percent(entry.change_7d))
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""An append-only, memory-mapped price store with one file per symbol.
+
+Each SYMBOL.prices file is a flat array of fixed-width (int64 timestamp,
+float64 price) records in timestamp order. ingest.py appends every tick to
+it, and readers map the files read-only, so any number of bot processes
+share the same page cache instead of each holding its own copy of the data.
+
+Example usage:
+  ./price_store.py build /var/lib/crypto/prices
+  ./ingest.py --price-store /var/lib/crypto/prices
+"""
+import argparse
+import collections
+import os
+import numpy as np
+
+RECORD_DTYPE = np.dtype([('timestamp', '<i8'), ('price', '<f8')])
+
+
+def _SearchSorted(column, values):
+  """np.searchsorted(column, values, side='right') for strided columns.
+
+  np.searchsorted copies a non-contiguous column first, which for a mapped
+  file means reading all of it. This bisects every value at once instead,
+  touching only the log(n) records each search visits.
+  """
+  values = np.asarray(values)
+  low = np.zeros(values.shape, dtype=np.int64)
+  high = np.full(values.shape, len(column), dtype=np.int64)
+  while True:
+    searching = low < high
+    if not searching.any():
+      return low
+    middle = (low + high) // 2
+    probe = np.where(searching, middle, 0)
+    if len(column):
+      go_right = searching & (column[probe] <= values)
+    else:
+      go_right = np.zeros(values.shape, dtype=bool)
+    low = np.where(go_right, middle + 1, low)
+    high = np.where(searching & ~go_right, middle, high)
+
+
+class MappedSeries(object):
+  """A read-only mapping of one symbol's price file.
+
+  Refresh() picks up records appended (or a file replaced) since the file
+  was last mapped.
+  """
+
+  def __init__(self, path):
+    self._path = path
+    self._stat = None
+    self._records = np.zeros(0, dtype=RECORD_DTYPE)
+    self.Refresh()
+
+  def Refresh(self):
+    try:
+      stat = os.stat(self._path)
+    except FileNotFoundError:
+      return
+    if self._stat and (stat.st_ino, stat.st_size) == (
+        self._stat.st_ino, self._stat.st_size):
+      return
+    self._stat = stat
+    # A partially written trailing record is ignored until it is complete.
+    count = stat.st_size // RECORD_DTYPE.itemsize
+    if count:
+      self._records = np.memmap(self._path, dtype=RECORD_DTYPE, mode='r',
+                                shape=(count,))
+    else:
+      self._records = np.zeros(0, dtype=RECORD_DTYPE)
+
+  def __len__(self):
+    return len(self._records)
+
+  def Last(self):
+    """The newest (timestamp, price) record, or None."""
+    if not len(self._records):
+      return None
+    record = self._records[-1]
+    return int(record['timestamp']), float(record['price'])
+
+  def GetValues(self, timestamps):
+    """Price at or before each timestamp, 0.0 where there is none."""
+    timestamps = np.asarray(timestamps)
+    bisect_points = _SearchSorted(self._records['timestamp'], timestamps)
+    if not len(self._records):
+      return np.zeros(timestamps.shape, dtype=np.float64)
+    values = self._records['price'][np.maximum(bisect_points - 1, 0)]
+    values = np.array(values, dtype=np.float64)
+    values[bisect_points == 0] = 0.0
+    return values
+
+
+class PriceStore(object):
+  """A directory of SYMBOL.prices files."""
+
+  def __init__(self, directory):
+    self._directory = directory
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+
+  def Path(self, symbol):
+    return os.path.join(self._directory, '%s.prices' % symbol.upper())
+
+  def Open(self, symbol):
+    return MappedSeries(self.Path(symbol))
+
+  def Append(self, rows):
+    """Appends (symbol, price, timestamp) rows.
+
+    Rows at or before a symbol's newest record are dropped, since the files
+    are append-only.
+
+    Returns:
+      The number of records written.
+    """
+    by_symbol = collections.defaultdict(list)
+    for symbol, price, timestamp in sorted(rows, key=lambda r: r[2]):
+      by_symbol[symbol.upper()].append((timestamp, price))
+    written = 0
+    for symbol, records in by_symbol.items():
+      path = self.Path(symbol)
+      last = self._LastTimestamp(path)
+      records = [r for r in records if last is None or r[0] > last]
+      if records:
+        with open(path, 'ab') as fp:
+          fp.write(np.array(records, dtype=RECORD_DTYPE).tobytes())
+        written += len(records)
+    return written
+
+  def _LastTimestamp(self, path):
+    if not os.path.exists(path):
+      return None
+    with open(path, 'r+b') as fp:
+      size = os.fstat(fp.fileno()).st_size
+      # Drop a partial record left behind by a crash mid-write.
+      complete = size - size % RECORD_DTYPE.itemsize
+      if complete != size:
+        fp.truncate(complete)
+      if not complete:
+        return None
+      fp.seek(complete - RECORD_DTYPE.itemsize)
+      return int(np.frombuffer(fp.read(), dtype=RECORD_DTYPE)[0]['timestamp'])
+
+  def Replace(self, symbol, timestamps, prices):
+    """Atomically replaces a symbol's file with the given sorted columns."""
+    records = np.zeros(len(timestamps), dtype=RECORD_DTYPE)
+    records['timestamp'] = timestamps
+    records['price'] = prices
+    path = self.Path(symbol)
+    with open(path + '.tmp', 'wb') as fp:
+      fp.write(records.tobytes())
+    os.replace(path + '.tmp', path)
+
+
+def Build(directory):
+  """Rebuilds every symbol's file from coinhistory."""
+  import sql
+  store = PriceStore(directory)
+  with sql.GetCursor() as cursor:
+    cursor.execute('SELECT DISTINCT symbol FROM coinhistory')
+    symbols = sorted(r[0] for r in cursor.fetchall())
+  for symbol in symbols:
+    with sql.GetCursor(streaming=True) as cursor:
+      cursor.execute(
+          'SELECT timestamp, price FROM coinhistory WHERE symbol = %s '
+          'ORDER BY timestamp', (symbol,))
+      timestamps, prices = sql.FetchColumns(cursor)
+    if len(timestamps):
+      store.Replace(symbol, timestamps, prices)
+    print('Built %s' % symbol)
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('command', choices=['build'])
+  parser.add_argument('directory')
+  args = parser.parse_args()
+  if args.command == 'build':
+    Build(args.directory)
+
+
+if __name__ == '__main__':
+  main()
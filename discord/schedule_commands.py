@@ -0,0 +1,172 @@
+from discord.ext import commands
+import datetime
+import io
+import traceback
+import crypto_commands
+import member_index
+import portfolio
+import portfolio_commands
+import scheduler
+import util
+
+class Schedule(object):
+  """Commands for posting lists, graphs and histories on a schedule."""
+
+  def __init__(self, bot):
+    self.bot = bot
+
+  async def RunBatch(self, jobs, now):
+    """Run jobs that are due together; passed to scheduler.RunForever.
+
+    Every job in the batch sees prices as of the same moment, and jobs that
+    would produce identical output (the same user's list, the same graph,
+    the same history) share one computation, whichever channels they post
+    to.
+    """
+    # Channels can only be looked up once the bot has connected.
+    await self.bot.wait_until_ready()
+    now = int(now)
+    results = {}
+    for job in jobs:
+      channel = self.bot.get_channel(job.channel_id)
+      if channel is None:
+        continue
+      try:
+        key, compute = self._Prepare(job, channel.server, now)
+        if key is None:
+          continue
+        if key not in results:
+          results[key] = await compute()
+        result = results[key]
+        if isinstance(result, bytes):
+          await self.bot.send_file(channel, io.BytesIO(result),
+                                   filename='graph.png')
+        else:
+          await self.bot.send_message(channel, result)
+      except Exception as e:
+        print('Exception in scheduled job %s:\n%s' % (
+            job.id, traceback.format_exc()))
+
+  def _Prepare(self, job, server, now):
+    """Returns the key identifying job's output, and a coroutine function
+    computing it. A key of None means there is nothing to post.
+    """
+    if job.command == 'list':
+      user = server.get_member(job.args['user_id'])
+      if user is None:
+        return None, None
+      async def List():
+        return portfolio_commands.FormatList(user, now)
+      return ('list', user.id), List
+    if job.command == 'graph':
+      if job.args['user_ids']:
+        users = [server.get_member(user_id)
+                 for user_id in job.args['user_ids']]
+        users = [user for user in users if user is not None]
+      else:
+        members = list(server.members)
+        portfolios = portfolio.LoadPortfolios([user.id for user in members])
+        users = [user for user in members if user.id in portfolios]
+      if not users:
+        return None, None
+      async def Graph():
+        return await portfolio_commands.GraphUsers(
+            users, job.args['time_delta'], now)
+      return ('graph', tuple(user.id for user in users),
+              job.args['time_delta']), Graph
+    async def History():
+      return crypto_commands.FormatHistory(
+          job.args['symbol'], job.args['time_str'], now)
+    return ('history', job.args['symbol'], job.args['time_str']), History
+
+  @commands.command(pass_context=True)
+  @commands.has_permissions(manage_messages=True)
+  async def schedule(self, ctx, interval : str, command : str, *args : str):
+    """Post !list, !graph or !history in this channel every interval.
+
+    Runs are lined up on the interval, so "1d" posts at midnight UTC and
+    "1h" on the hour. The shortest interval is 10 minutes.
+
+    example: !schedule 1d list
+    example: !schedule 12h graph 7d
+    example: !schedule 1h history BTC 24h
+    """
+    message = ctx.message
+    seconds = util.GetTimeDelta(interval).total_seconds()
+    if command in ('list', 'ls', 'display'):
+      command = 'list'
+      user = message.author
+      if args:
+        user = member_index.GetMemberFromNameStr(message.server, args[0])
+      if user is None:
+        await self.bot.say('Unknown user %s.' % args[0])
+        return
+      job_args = {'user_id': user.id}
+    elif command == 'graph':
+      # An empty user_ids graphs the whole server, so a name that doesn't
+      # resolve must not just be left out.
+      user_ids = []
+      for name in args[1:]:
+        user = member_index.GetMemberFromNameStr(message.server, name)
+        if user is None:
+          await self.bot.say('Unknown user %s.' % name)
+          return
+        user_ids.append(user.id)
+      job_args = {'time_delta': args[0] if args else '',
+                  'user_ids': user_ids}
+    elif command in ('history', 'hist') and args:
+      command = 'history'
+      job_args = {'symbol': args[0].upper(),
+                  'time_str': ' '.join(args[1:]) or '24 hours'}
+    else:
+      seconds = 0
+    if not seconds:
+      await self.bot.say('Format has to be "!schedule INTERVAL list|graph|'
+                         'history ARGS...", e.g. "!schedule 1d list".')
+      return
+    try:
+      job = scheduler.Create(message.server.id, message.channel.id,
+                             message.author.id, command, job_args, seconds)
+    except scheduler.JobLimitReached:
+      await self.bot.say('This channel already has %s scheduled posts, '
+                         'remove some with !unschedule.' %
+                         scheduler.MAX_JOBS_PER_CHANNEL)
+      return
+    await self.bot.say('Scheduled post %s: !%s %s every %s, starting %s UTC.' %
+                       (job.id, command, ' '.join(args), interval,
+                        _FormatTime(job.next_run)))
+
+  @commands.command(pass_context=True)
+  async def schedules(self, ctx):
+    """List the scheduled posts in this channel."""
+    jobs = scheduler.GetJobs(ctx.message.channel.id)
+    if not jobs:
+      await self.bot.say('Nothing is scheduled in this channel.')
+      return
+    await self.bot.say('```Scheduled posts:\n%s```' % '\n'.join(
+        '%s: !%s %s every %gh, next at %s UTC' % (
+            job.id, job.command, _DescribeArgs(job), job.interval / 3600,
+            _FormatTime(job.next_run))
+        for job in jobs))
+
+  @commands.command(pass_context=True)
+  @commands.has_permissions(manage_messages=True)
+  async def unschedule(self, ctx, job_id : int):
+    """Remove a scheduled post, by the number !schedules lists it under."""
+    if scheduler.Delete(ctx.message.channel.id, job_id):
+      await self.bot.say('Removed scheduled post %s.' % job_id)
+    else:
+      await self.bot.say('This channel has no scheduled post %s.' % job_id)
+
+
+def _FormatTime(timestamp):
+  return datetime.datetime.utcfromtimestamp(timestamp).strftime(
+      '%Y/%m/%d %H:%M')
+
+
+def _DescribeArgs(job):
+  if job.command == 'history':
+    return '%s %s' % (job.args['symbol'], job.args['time_str'])
+  if job.command == 'graph':
+    return job.args['time_delta']
+  return ''
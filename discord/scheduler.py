@@ -0,0 +1,172 @@
+"""Recurring jobs that post command output to a channel on a schedule.
+
+Jobs are stored in the scheduled_jobs table and kept in memory in a heap
+ordered by their next run time, so the scheduler only ever looks at the
+earliest one. Run times are aligned to a grid of each job's interval from
+the epoch (hourly jobs fire on the hour, daily ones at midnight UTC), so
+jobs with the same interval fire together. Everything due at the same
+moment is handed to the runner as one batch, which lets it compute shared
+results once.
+
+A job that was due while the bot was down runs once at startup, and is
+then put back on its grid; missed runs are skipped rather than caught up.
+
+Example usage:
+  scheduler.Load()
+  bot.loop.create_task(scheduler.RunForever(RunBatch))
+"""
+import asyncio
+import heapq
+import json
+import time
+import traceback
+import metrics
+import sql
+
+# Jobs can't be scheduled more often than this.
+MIN_INTERVAL = 600
+# The most jobs a channel can have.
+MAX_JOBS_PER_CHANNEL = 10
+# The longest the scheduler sleeps without checking the heap again.
+MAX_SLEEP = 3600
+
+_jobs = {}
+# (next_run, job id) pairs. Entries for deleted or rescheduled jobs are left
+# in place and skipped when they reach the top.
+_heap = []
+_wakeup = None
+
+
+class JobLimitReached(Exception):
+  """The channel already has MAX_JOBS_PER_CHANNEL jobs."""
+
+
+class Job(object):
+  """A command to run in a channel every interval seconds.
+
+  Attributes:
+    command: 'list', 'graph' or 'history'.
+    args: A dict of the command's arguments.
+  """
+
+  def __init__(self, job_id, server_id, channel_id, user_id, command, args,
+               interval, next_run):
+    self.id = job_id
+    self.server_id = server_id
+    self.channel_id = channel_id
+    self.user_id = user_id
+    self.command = command
+    self.args = args
+    self.interval = interval
+    self.next_run = next_run
+
+
+def NextRun(interval, now):
+  """The first point on interval's grid strictly after now."""
+  return int(now - now % interval + interval)
+
+
+def Load():
+  """Read every job from the database and schedule it."""
+  _jobs.clear()
+  del _heap[:]
+  with sql.GetCursor(streaming=True) as cursor:
+    cursor.execute(
+        'SELECT id, server_id, channel_id, user_id, command, args, '
+        'interval_seconds, next_run FROM scheduled_jobs')
+    for row in sql.IterRows(cursor):
+      job = Job(*row)
+      job.args = json.loads(job.args)
+      _Schedule(job)
+
+
+def _Schedule(job):
+  _jobs[job.id] = job
+  heapq.heappush(_heap, (job.next_run, job.id))
+  if _wakeup is not None:
+    _wakeup.set()
+
+
+def Create(server_id, channel_id, user_id, command, args, interval, now=None):
+  """Store a new job and schedule its first run on its interval's grid.
+
+  Raises:
+    JobLimitReached: If the channel has too many jobs.
+  """
+  if len(GetJobs(channel_id)) >= MAX_JOBS_PER_CHANNEL:
+    raise JobLimitReached()
+  interval = max(int(interval), MIN_INTERVAL)
+  next_run = NextRun(interval, now or time.time())
+  with sql.GetCursor() as cursor:
+    cursor.execute(
+        'INSERT INTO scheduled_jobs (server_id, channel_id, user_id, command, '
+        'args, interval_seconds, next_run) VALUES (%s, %s, %s, %s, %s, %s, %s)',
+        (server_id, channel_id, user_id, command, json.dumps(args), interval,
+         next_run))
+    job = Job(cursor.lastrowid, server_id, channel_id, user_id, command, args,
+              interval, next_run)
+  _Schedule(job)
+  return job
+
+
+def Delete(channel_id, job_id):
+  """Delete one of a channel's jobs. Returns whether it existed."""
+  job = _jobs.get(job_id)
+  if job is None or job.channel_id != channel_id:
+    return False
+  del _jobs[job_id]
+  with sql.GetCursor() as cursor:
+    cursor.execute('DELETE FROM scheduled_jobs WHERE id = %s', (job_id,))
+  return True
+
+
+def GetJobs(channel_id):
+  return sorted((job for job in _jobs.values()
+                 if job.channel_id == channel_id), key=lambda job: job.id)
+
+
+def _PopDue(now):
+  due = []
+  while _heap and _heap[0][0] <= now:
+    next_run, job_id = heapq.heappop(_heap)
+    job = _jobs.get(job_id)
+    if job is not None and job.next_run == next_run:
+      due.append(job)
+  return due
+
+
+def _Reschedule(jobs, now):
+  if not jobs:
+    return
+  for job in jobs:
+    job.next_run = NextRun(job.interval, now)
+    heapq.heappush(_heap, (job.next_run, job.id))
+  with sql.GetCursor() as cursor:
+    cursor.executemany(
+        'UPDATE scheduled_jobs SET next_run = %s WHERE id = %s',
+        [(job.next_run, job.id) for job in jobs])
+
+
+async def RunForever(run_batch, clock=time.time):
+  """Run due jobs forever, as await run_batch(jobs, now) for each batch."""
+  global _wakeup
+  _wakeup = asyncio.Event()
+  while True:
+    now = clock()
+    due = _PopDue(now)
+    if due:
+      try:
+        with metrics.Timer('scheduler.batch'):
+          await run_batch(due, now)
+        metrics.Increment('scheduler.jobs', len(due))
+      except Exception as e:
+        print('Exception in scheduled jobs:\n%s' % (traceback.format_exc()))
+      # Jobs deleted while the batch ran are not put back.
+      _Reschedule([job for job in due if job.id in _jobs], now)
+      continue
+    timeout = min(_heap[0][0] - now, MAX_SLEEP) if _heap else MAX_SLEEP
+    _wakeup.clear()
+    try:
+      await asyncio.wait_for(_wakeup.wait(), timeout)
+    except asyncio.TimeoutError:
+      pass
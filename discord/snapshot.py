@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+"""Compact binary snapshots of coinhistory, for warm starting the bot.
+
+A snapshot holds every symbol's raw price history up to a cutoff timestamp,
+stored column-wise: each symbol's timestamps as uint32 deltas from its first
+timestamp, followed by its prices as float32 or float64. The file is
+memory-mapped when loaded, so prices are read straight out of the page cache.
+
+Layout (little-endian):
+  header: magic, index offset, symbol count, cutoff timestamp
+  data:   per symbol, uint32 timestamp deltas then prices, 8 byte aligned
+  index:  one _INDEX_DTYPE record per symbol
+
+Example usage:
+  ./snapshot.py export /var/lib/crypto/coinhistory.snap
+  ./snapshot.py info /var/lib/crypto/coinhistory.snap
+"""
+import argparse
+import mmap
+import time
+import numpy as np
+
+MAGIC = b'CSNAP001'
+# The most bytes of utf-8 a symbol can take up in the index.
+SYMBOL_BYTES = 16
+_HEADER_DTYPE = np.dtype([
+    ('magic', 'S8'), ('index_offset', '<u8'), ('count', '<u8'),
+    ('cutoff', '<i8')])
+_INDEX_DTYPE = np.dtype([
+    ('symbol', 'S%d' % SYMBOL_BYTES), ('offset', '<u8'), ('count', '<u8'),
+    ('first_timestamp', '<i8'), ('last_timestamp', '<i8'),
+    ('price_bytes', '<u8')])
+
+
+def _EncodeSymbol(symbol):
+  """The symbol as stored in the index, or None if it doesn't fit there."""
+  encoded = symbol.encode('utf-8')
+  if len(encoded) > SYMBOL_BYTES or encoded.endswith(b'\0'):
+    return None
+  return encoded
+
+
+def Fits(symbol):
+  """Whether a snapshot can store symbol."""
+  return _EncodeSymbol(symbol) is not None
+
+
+class SnapshotWriter(object):
+  """Writes a snapshot one symbol at a time.
+
+  Example usage:
+    with SnapshotWriter(path, cutoff) as writer:
+      writer.Add('BTC', timestamps, prices)
+  """
+
+  def __init__(self, path, cutoff, price_dtype=np.float64):
+    self._fp = open(path, 'wb')
+    self._cutoff = cutoff
+    self._price_dtype = np.dtype(price_dtype).newbyteorder('<')
+    self._index = []
+    self._fp.write(np.zeros(1, dtype=_HEADER_DTYPE).tobytes())
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exception, value, traceback):
+    if not exception:
+      self.Close()
+    else:
+      self._fp.close()
+
+  def Add(self, symbol, timestamps, prices):
+    """Adds a symbol's sorted timestamp and price columns.
+
+    Raises:
+      ValueError: If the symbol doesn't fit in the index.
+    """
+    encoded = _EncodeSymbol(symbol)
+    if encoded is None:
+      raise ValueError('%r is too long for a snapshot' % symbol)
+    if not len(timestamps):
+      return
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    deltas = timestamps - timestamps[0]
+    if deltas.max() > np.iinfo(np.uint32).max:
+      raise ValueError('%s spans too long to delta-encode' % symbol)
+    offset = self._fp.tell()
+    self._Write(deltas.astype('<u4'))
+    self._Write(np.asarray(prices).astype(self._price_dtype))
+    self._index.append((encoded, offset, len(timestamps),
+                        timestamps[0], timestamps[-1],
+                        self._price_dtype.itemsize))
+
+  def _Write(self, array):
+    self._fp.write(array.tobytes())
+    padding = -self._fp.tell() % 8
+    self._fp.write(b'\0' * padding)
+
+  def Close(self):
+    index_offset = self._fp.tell()
+    self._fp.write(np.array(self._index, dtype=_INDEX_DTYPE).tobytes())
+    header = np.array([(MAGIC, index_offset, len(self._index), self._cutoff)],
+                      dtype=_HEADER_DTYPE)
+    self._fp.seek(0)
+    self._fp.write(header.tobytes())
+    self._fp.close()
+
+
+class Snapshot(object):
+  """A memory-mapped snapshot file.
+
+  The snapshot is complete up to GetCutoff(): any row in coinhistory at or
+  before it for any symbol is in the snapshot.
+  """
+
+  def __init__(self, path):
+    with open(path, 'rb') as fp:
+      self._mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    header = np.frombuffer(self._mmap, dtype=_HEADER_DTYPE, count=1)[0]
+    if header['magic'] != MAGIC:
+      raise ValueError('%s is not a coinhistory snapshot' % path)
+    self._cutoff = int(header['cutoff'])
+    index = np.frombuffer(self._mmap, dtype=_INDEX_DTYPE,
+                          count=int(header['count']),
+                          offset=int(header['index_offset']))
+    self._index = {record['symbol'].decode('utf-8'): record
+                   for record in index}
+
+  def GetCutoff(self):
+    return self._cutoff
+
+  def Symbols(self):
+    return sorted(self._index)
+
+  def __contains__(self, symbol):
+    return symbol in self._index
+
+  def Covers(self, symbol):
+    """Whether the snapshot has all of symbol's rows up to the cutoff.
+
+    That is true of every symbol it can store, including those that had no
+    rows, but not of symbols that Export had to leave out.
+    """
+    return symbol in self._index or Fits(symbol)
+
+  def Get(self, symbol):
+    """Returns a symbol's (timestamps, prices) columns.
+
+    Timestamps are decoded into a new int64 array; prices are a read-only
+    view of the mapped file.
+    """
+    record = self._index[symbol]
+    count = int(record['count'])
+    offset = int(record['offset'])
+    deltas = np.frombuffer(self._mmap, dtype='<u4', count=count, offset=offset)
+    offset += 4*count + (-4*count % 8)
+    prices = np.frombuffer(self._mmap, dtype='<f%d' % record['price_bytes'],
+                           count=count, offset=offset)
+    return int(record['first_timestamp']) + deltas.astype(np.int64), prices
+
+
+def Export(path, price_dtype=np.float64):
+  """Writes all of coinhistory, up to its newest tick, to a snapshot."""
+  import sql
+  with sql.GetCursor() as cursor:
+    cursor.execute('SELECT MAX(timestamp) FROM coinhistory')
+    cutoff = cursor.fetchone()[0] or 0
+    cursor.execute('SELECT DISTINCT symbol FROM coinhistory')
+    symbols = sorted(r[0] for r in cursor.fetchall())
+  with SnapshotWriter(path, cutoff, price_dtype) as writer:
+    for symbol in symbols:
+      if not Fits(symbol):
+        print('Skipped %r, which is too long for a snapshot' % symbol)
+        continue
+      with sql.GetCursor(streaming=True) as cursor:
+        cursor.execute(
+            'SELECT timestamp, price FROM coinhistory WHERE symbol = %s '
+            'AND timestamp <= %s ORDER BY timestamp', (symbol, cutoff))
+        timestamps, prices = sql.FetchColumns(cursor)
+      if len(timestamps):
+        writer.Add(symbol, timestamps, prices)
+  return cutoff
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  subparsers = parser.add_subparsers(dest='command')
+  export = subparsers.add_parser('export', help='Write coinhistory to a file.')
+  export.add_argument('path')
+  export.add_argument('--float32', action='store_true',
+                      help='Store prices as float32 to halve their size.')
+  info = subparsers.add_parser('info', help='Describe a snapshot file.')
+  info.add_argument('path')
+  args = parser.parse_args()
+
+  if args.command == 'export':
+    start = time.time()
+    cutoff = Export(args.path, np.float32 if args.float32 else np.float64)
+    print('Exported coinhistory up to %s in %.1fs' % (
+        cutoff, time.time() - start))
+  elif args.command == 'info':
+    snapshot = Snapshot(args.path)
+    print('cutoff: %s, symbols: %s' % (
+        snapshot.GetCutoff(), len(snapshot.Symbols())))
+  else:
+    parser.print_help()
+
+
+if __name__ == '__main__':
+  main()
@@ -1,39 +1,68 @@
 """MySQLdb doesn't really support threading very well out of the box.
 
-This file should maintain a threadsafe pool of database connections.
+This file maintains a threadsafe, bounded pool of database connections.
+Connections are checked out when a with block is entered and always returned
+when it exits, so callers can use them from executor threads as well as from
+the event loop.
 
 Example usage:
   with GetCursor() as cursor:
     cursor.execute(
         'SELECT timestamp, price FROM coinhistory '
-        'where symbol = "%s"' % self.GetSymbol())
+        'where symbol = %s', (self.GetSymbol(),))
     for t in cursor.fetchall():
       self[t[0]] = t[1]
+
+Large results should be streamed rather than fetched all at once:
+  with GetCursor(streaming=True) as cursor:
+    cursor.execute('SELECT timestamp, price FROM coinhistory')
+    for rows in IterChunks(cursor):
+      ...
+
+Every statement's execution time and row count is recorded in metrics.py,
+keyed by the first STATEMENT_NAME_LENGTH characters of its query.
 """
-from MySQLdb import connections
-import util
+import MySQLdb
+import MySQLdb.cursors
 import json
-_pool = []
+import metrics
+import numpy as np
+import re
+import threading
+import time
+import util
 
-class _Connection(connections.Connection):
+# The most connections the pool will ever have open at once.
+MAX_CONNECTIONS = 8
+# How long GetCursor waits for a connection before raising PoolTimeout.
+ACQUIRE_TIMEOUT = 30
+# Connections that sat idle for longer than this are pinged before reuse.
+MAX_IDLE_SECONDS = 60
+# How many rows IterChunks pulls from the server at a time.
+CHUNK_SIZE = 10000
+# How much of a query is kept as its name in the metrics.
+STATEMENT_NAME_LENGTH = 60
 
-  def __enter__(self):
-    self.ping(True)
-    self._cursor = super(_Connection, self).cursor()
-    return self._cursor
+_connection_settings = None
+# Memoized metric names by query string.
+_statement_names = {}
 
-  def __exit__(self, exception, value, traceback):
-    if exception:
-      self.rollback()
-    self._cursor.close()
-    _pool.append(self)
-
-def GetCursor():
-  if _pool:
-    return _pool.pop()
-  with open(util.GetSettingsFilepath('crypto-db')) as fp:
-    connection_details = json.load(fp)
-  connection = _Connection(
+
+class PoolTimeout(Exception):
+  """No connection became available within ACQUIRE_TIMEOUT seconds."""
+
+
+def _ConnectionSettings():
+  global _connection_settings
+  if _connection_settings is None:
+    with open(util.GetSettingsFilepath('crypto-db')) as fp:
+      _connection_settings = json.load(fp)
+  return _connection_settings
+
+
+def _Connect():
+  connection_details = _ConnectionSettings()
+  connection = MySQLdb.connect(
       host=connection_details['host'],
       user=connection_details['user'],
       password=connection_details['password'],
@@ -41,3 +70,254 @@ def GetCursor():
   connection.autocommit(True)
   return connection
 
+
+class _Pool(object):
+
+  def __init__(self, max_size, timeout, max_idle, connect=_Connect):
+    self._connect = connect
+    self._max_size = max_size
+    self._timeout = timeout
+    self._max_idle = max_idle
+    self._condition = threading.Condition()
+    # (connection, time it was returned) pairs, most recently used last.
+    self._idle = []
+    self._open = 0
+    self.checkouts = 0
+    self.waits = 0
+    self.wait_seconds = 0.0
+
+  def Acquire(self):
+    with self._condition:
+      if not self._idle and self._open >= self._max_size:
+        self.waits += 1
+        start = time.time()
+        deadline = start + self._timeout
+        while not self._idle and self._open >= self._max_size:
+          remaining = deadline - time.time()
+          if remaining <= 0:
+            self.wait_seconds += time.time() - start
+            raise PoolTimeout('No database connection free after %ss' %
+                              self._timeout)
+          self._condition.wait(remaining)
+        self.wait_seconds += time.time() - start
+      self.checkouts += 1
+      if self._idle:
+        connection, last_used = self._idle.pop()
+      else:
+        connection, last_used = None, None
+        self._open += 1
+
+    try:
+      if connection is None:
+        return self._connect()
+      if time.time() - last_used > self._max_idle:
+        try:
+          connection.ping()
+        except MySQLdb.Error:
+          self._Close(connection)
+          return self._connect()
+      return connection
+    except Exception:
+      self.Release(None, broken=True)
+      raise
+
+  def Release(self, connection, broken=False):
+    if broken:
+      self._Close(connection)
+    with self._condition:
+      if broken:
+        self._open -= 1
+      else:
+        self._idle.append((connection, time.time()))
+      self._condition.notify()
+
+  def _Close(self, connection):
+    if connection is None:
+      return
+    try:
+      connection.close()
+    except MySQLdb.Error:
+      pass
+
+  def Stats(self):
+    with self._condition:
+      return {
+          'open': self._open,
+          'idle': len(self._idle),
+          'in_use': self._open - len(self._idle),
+          'checkouts': self.checkouts,
+          'waits': self.waits,
+          'wait_seconds': self.wait_seconds,
+      }
+
+
+_pool = _Pool(MAX_CONNECTIONS, ACQUIRE_TIMEOUT, MAX_IDLE_SECONDS)
+
+
+def UseConnectionFactory(connect):
+  """Replace the pool with one whose connections come from connect().
+
+  Meant for benchmarks and tools that run against a stand-in database; the
+  connections only need the subset of the MySQLdb API this module uses.
+  """
+  global _pool
+  _pool = _Pool(MAX_CONNECTIONS, ACQUIRE_TIMEOUT, MAX_IDLE_SECONDS, connect)
+
+
+def _StatementName(query):
+  name = _statement_names.get(query)
+  if name is None:
+    if len(_statement_names) > 1000:
+      # Queries with inlined lists can be unique; don't grow without bound.
+      _statement_names.clear()
+    name = _statement_names[query] = 'sql: ' + re.sub(
+        r'\s+', ' ', query).strip()[:STATEMENT_NAME_LENGTH]
+  return name
+
+
+class _TimedCursor(object):
+  """Wraps a cursor, recording statement latencies and row counts."""
+
+  def __init__(self, cursor):
+    self._cursor = cursor
+    self._name = None
+
+  def __getattr__(self, attr):
+    return getattr(self._cursor, attr)
+
+  def _Execute(self, method, query, args):
+    self._name = _StatementName(query)
+    start = time.perf_counter()
+    try:
+      return method(query, args)
+    finally:
+      metrics.Observe(self._name, time.perf_counter() - start)
+      if self._cursor.description is None and self._cursor.rowcount > 0:
+        # Writes; reads are counted as their rows are fetched.
+        metrics.Increment(self._name + '.rows', self._cursor.rowcount)
+
+  def execute(self, query, args=None):
+    return self._Execute(self._cursor.execute, query, args)
+
+  def executemany(self, query, args):
+    return self._Execute(self._cursor.executemany, query, args)
+
+  def _Fetch(self, method, *args):
+    # Streaming cursors do most of their work here rather than in execute.
+    start = time.perf_counter()
+    result = method(*args)
+    metrics.Observe(self._name + '.fetch', time.perf_counter() - start)
+    return result
+
+  def fetchone(self):
+    row = self._Fetch(self._cursor.fetchone)
+    if row is not None:
+      metrics.Increment(self._name + '.rows')
+    return row
+
+  def fetchmany(self, size):
+    rows = self._Fetch(self._cursor.fetchmany, size)
+    metrics.Increment(self._name + '.rows', len(rows))
+    return rows
+
+  def fetchall(self):
+    rows = self._Fetch(self._cursor.fetchall)
+    metrics.Increment(self._name + '.rows', len(rows))
+    return rows
+
+
+class _Checkout(object):
+  """Holds a pooled connection for the duration of a with block."""
+
+  def __init__(self, transaction, streaming):
+    self._transaction = transaction
+    self._streaming = streaming
+    self._connection = None
+    self._cursor = None
+
+  def __enter__(self):
+    self._connection = _pool.Acquire()
+    try:
+      if self._streaming:
+        cursor = self._connection.cursor(MySQLdb.cursors.SSCursor)
+      else:
+        cursor = self._connection.cursor()
+      self._cursor = _TimedCursor(cursor)
+      if self._transaction:
+        self._cursor.execute('START TRANSACTION')
+    except Exception:
+      _pool.Release(self._connection, broken=True)
+      raise
+    return self._cursor
+
+  def __exit__(self, exception, value, traceback):
+    broken = False
+    try:
+      if exception:
+        self._connection.rollback()
+      elif self._transaction:
+        self._connection.commit()
+      self._cursor.close()
+    except MySQLdb.Error:
+      broken = True
+      raise
+    finally:
+      _pool.Release(self._connection, broken=broken)
+
+
+def GetCursor(transaction=False, streaming=False):
+  """Get a pooled cursor, to be used as a context manager.
+
+  Args:
+    transaction: If true, everything executed inside the with block is
+      committed as a single transaction (and rolled back on exception).
+    streaming: If true, the cursor is server-side: rows are sent as they
+      are fetched instead of being buffered on the client when the query is
+      executed. Read results with IterChunks/IterRows.
+  """
+  return _Checkout(transaction, streaming)
+
+
+def IterChunks(cursor, chunk_size=CHUNK_SIZE):
+  """Yields the rows of an executed query in lists of at most chunk_size."""
+  while True:
+    rows = cursor.fetchmany(chunk_size)
+    if not rows:
+      return
+    yield rows
+
+
+def IterRows(cursor, chunk_size=CHUNK_SIZE):
+  """Yields the rows of an executed query one at a time, chunk by chunk."""
+  for rows in IterChunks(cursor, chunk_size):
+    for row in rows:
+      yield row
+
+
+def FetchColumns(cursor, chunk_size=CHUNK_SIZE):
+  """Reads an executed (timestamp, price) query into numpy columns.
+
+  Only one chunk of row tuples is alive at a time, so this works on
+  streaming cursors without holding the whole result as Python objects.
+
+  Returns:
+    A tuple of int64 timestamp and float64 price numpy arrays.
+  """
+  timestamp_chunks = []
+  price_chunks = []
+  for rows in IterChunks(cursor, chunk_size):
+    timestamp_chunks.append(np.fromiter(
+        (r[0] for r in rows), dtype=np.int64, count=len(rows)))
+    price_chunks.append(np.fromiter(
+        (r[1] for r in rows), dtype=np.float64, count=len(rows)))
+  if not timestamp_chunks:
+    return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+  return np.concatenate(timestamp_chunks), np.concatenate(price_chunks)
+
+
+def GetPoolStats():
+  """Counters for sizing the pool: checkouts, waits, wait time and more."""
+  return _pool.Stats()
+
+
+metrics.RegisterGauge('sql_pool', GetPoolStats)
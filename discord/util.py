@@ -1,9 +1,13 @@
 """Utility functions that didn't fit anywhere else."""
 from datetime import timedelta, datetime
 import difflib
+import importlib
 import os
 import pytz
 import re
+import time
+
+_import_times = []
 
 def GetTimestamp(s):
   """Convert 'YYYY/MM/DD(HH:MM:SS)' strings to a unix timestamp.
@@ -28,7 +32,11 @@ def GetTimestamp(s):
 
 
 def GetUserFromNameStr(users, name_str):
-  """Given an iterable of discord.Users, find the one with the closest name."""
+  """Given an iterable of discord.Users, find the one with the closest name.
+
+  This scores every user, so to search a whole server use
+  member_index.GetMemberFromNameStr instead.
+  """
   best_user_so_far = None
   best_score_so_far = 0
 
@@ -47,6 +55,28 @@ def GetUserFromNameStr(users, name_str):
   return best_user_so_far
 
 
+def TimedImport(name):
+  """Import a module by name, recording how long it took.
+
+  Modules pulled in by an earlier import are already loaded and show up as
+  (nearly) free, so the report attributes each dependency to the first
+  import that needed it.
+  """
+  start = time.time()
+  module = importlib.import_module(name)
+  _import_times.append((name, time.time() - start))
+  return module
+
+
+def GetImportReport():
+  """A printable breakdown of the time spent in TimedImport calls."""
+  lines = ['%-20s %7.1fms' % (name, 1000*seconds)
+           for name, seconds in _import_times]
+  lines.append('%-20s %7.1fms' % (
+      'total', 1000*sum(seconds for _, seconds in _import_times)))
+  return '\n'.join(lines)
+
+
 def GetSettingsFilepath(filename):
   if os.name != 'nt':
     return '/etc/%s' % filename
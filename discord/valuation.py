@@ -0,0 +1,43 @@
+"""Vectorized valuation of portfolios over a grid of timestamps.
+
+Rather than asking every portfolio for its value one timestamp and one coin at
+a time, this builds a holdings matrix per portfolio and a price column per
+coin, and combines them with numpy. Price columns are shared between all of
+the portfolios being valued.
+"""
+import numpy as np
+import coin_data
+
+
+def GetValueMatrix(portfolios, t_list, resolution=None):
+  """Values a set of portfolios at every timestamp in t_list.
+
+  Args:
+    portfolios: A list of portfolio.PortfolioHistory objects.
+    t_list: A list of unix timestamps.
+    resolution: The coin_data resolution to read prices at. By default the
+      coarsest one whose buckets fit between the timestamps.
+
+  Returns:
+    A len(portfolios) x len(t_list) numpy array of USD values.
+  """
+  t_array = np.asarray(t_list)
+  if not len(t_array):
+    return np.zeros((len(portfolios), 0))
+  if resolution is None:
+    resolution = coin_data.SelectResolution(
+        t_array.min(), t_array.max(), len(t_array) - 1)
+  holdings = [p.GetHoldingsMatrix(t_array) for p in portfolios]
+  symbols = sorted(set(s for owned, _ in holdings for s in owned))
+  columns = {symbol: i for i, symbol in enumerate(symbols)}
+  prices = np.zeros((len(t_array), len(symbols)))
+  for symbol, column in columns.items():
+    prices[:, column] = coin_data.GetHistory(
+        symbol, resolution).GetValues(t_array)
+
+  values = np.zeros((len(portfolios), len(t_array)))
+  for row, (owned, amounts) in enumerate(holdings):
+    if owned:
+      owned_prices = prices[:, [columns[s] for s in owned]]
+      values[row] = np.einsum('ts,ts->t', amounts, owned_prices)
+  return values
@@ -0,0 +1,78 @@
+-- Tables used alongside the existing coinhistory and transactions tables.
+
+-- coinhistory is keyed on (symbol, timestamp), which doesn't help queries on
+-- timestamp alone, such as the bot reading back a new tick. On an existing
+-- deployment, run once:
+--   ALTER TABLE coinhistory ADD INDEX timestamp (timestamp);
+-- (This can take a while on a large table.)
+
+-- One row per tick written by ingest.py. The bot polls this small table to
+-- find new ticks instead of scanning coinhistory. On an existing deployment,
+-- backfill it once after adding the index above:
+--   INSERT IGNORE INTO ticks SELECT DISTINCT timestamp FROM coinhistory;
+CREATE TABLE IF NOT EXISTS ticks (
+  timestamp INT NOT NULL,
+  PRIMARY KEY (timestamp)
+);
+
+-- Hourly and daily OHLC rollups of coinhistory, maintained by ingest.py.
+-- `bucket` is the unix timestamp the bucket starts at; open_timestamp and
+-- close_timestamp are the ticks the open and close prices came from.
+CREATE TABLE IF NOT EXISTS coinhistory_hourly (
+  symbol VARCHAR(16) NOT NULL,
+  bucket INT NOT NULL,
+  open DOUBLE NOT NULL,
+  open_timestamp INT NOT NULL,
+  high DOUBLE NOT NULL,
+  low DOUBLE NOT NULL,
+  close DOUBLE NOT NULL,
+  close_timestamp INT NOT NULL,
+  PRIMARY KEY (symbol, bucket),
+  INDEX symbol_close_timestamp (symbol, close_timestamp)
+);
+
+CREATE TABLE IF NOT EXISTS coinhistory_daily LIKE coinhistory_hourly;
+
+-- Price alerts registered with !alert (see alerts.py). An alert fires once
+-- when the price reaches `above` or `below`, whichever is set; percent
+-- alerts set both, around the `base` price they were registered at.
+CREATE TABLE IF NOT EXISTS alerts (
+  id INT NOT NULL AUTO_INCREMENT,
+  user_id VARCHAR(32) NOT NULL,
+  symbol VARCHAR(16) NOT NULL,
+  above DOUBLE,
+  below DOUBLE,
+  percent DOUBLE,
+  base DOUBLE,
+  PRIMARY KEY (id),
+  INDEX user_id (user_id)
+);
+
+-- Recurring posts registered with !schedule (see scheduler.py). `args` is a
+-- json object of the command's arguments; next_run is a unix timestamp.
+CREATE TABLE IF NOT EXISTS scheduled_jobs (
+  id INT NOT NULL AUTO_INCREMENT,
+  server_id VARCHAR(32) NOT NULL,
+  channel_id VARCHAR(32) NOT NULL,
+  user_id VARCHAR(32) NOT NULL,
+  command VARCHAR(16) NOT NULL,
+  args TEXT NOT NULL,
+  interval_seconds INT NOT NULL,
+  next_run INT NOT NULL,
+  PRIMARY KEY (id),
+  INDEX channel_id (channel_id)
+);
+
+-- Every portfolio's position by value at the end of each day (see
+-- leaderboard.py). `day` is the unix timestamp of midnight UTC; the changes
+-- are percentages, NULL when the portfolio was worth nothing before.
+CREATE TABLE IF NOT EXISTS daily_rankings (
+  day INT NOT NULL,
+  user_id VARCHAR(32) NOT NULL,
+  position INT NOT NULL,
+  value DOUBLE NOT NULL,
+  change_24h DOUBLE,
+  change_7d DOUBLE,
+  PRIMARY KEY (day, user_id),
+  INDEX user_id_day (user_id, day)
+);